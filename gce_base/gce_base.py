@@ -1,8 +1,9 @@
 from abc import ABCMeta
-from typing import Dict, Any
+from typing import Dict, Any, Iterator, Tuple
 
 import proto
 
+from labeling_session import LabelingSession
 from plugin import Plugin
 from util.gcp.gcp_utils import (
     cloudclient_pb_obj_to_dict,
@@ -15,14 +16,100 @@ class GceBase(Plugin, metaclass=ABCMeta):
     def _discovery_api():
         return "compute", "v1"
 
+    @staticmethod
+    def _resource_fields():
+        return "name", "labels", "labelFingerprint", "selfLink"
+
+    @staticmethod
+    def _label_state_version_fields():
+        # Changes whenever labels do; GCE resources have no etag
+        return ("labelFingerprint",)
+
+    @staticmethod
+    def _unlabeled_filter(label_key):
+        return f"NOT labels.{label_key}:*"
+
+    def __list_metadata(self):
+        fields_mask = self._list_fields_mask()
+        return (("x-goog-fieldmask", fields_mask),) if fields_mask else ()
+
     def _gcp_name(self, gcp_object):
         """Method dynamically called in generating labels, so don't change name"""
         return self._name_no_separator(gcp_object)
 
     def _get_resource_as_dict(self, request: proto.Message) -> Dict[str, Any]:
         inst = self._cloudclient().get(request)
-        return cloudclient_pb_obj_to_dict(inst)
+        return cloudclient_pb_obj_to_dict(inst, self._projected_fields())
+
+    def _on_listed(self, session: LabelingSession, o):
+        """Called with each resource as it is listed, before unchanged resources
+        are skipped. The resource is a Cloud Client object."""
+        pass
+
+    def _on_unlisted_scope(self, session: LabelingSession, scope: str, warning):
+        """Called with each scope of an aggregated listing whose resources could not be
+        listed (e.g. an unreachable zone), with the warning returned for it."""
+        pass
+
+    def __changed_as_dicts(
+        self, session: LabelingSession, objects
+    ) -> Iterator[Dict[str, Any]]:
+        def changed():
+            for o in objects:
+                self._on_listed(session, o)
+                if not self._unchanged_since_last_run(session, o):
+                    yield o
+
+        return cloudclient_pb_objects_to_list_of_dicts(
+            changed(), self._projected_fields()
+        )
+
+    def _list_resources_as_dicts(
+        self, request: proto.Message, session: LabelingSession
+    ):
+        objects = self._cloudclient().list(
+            request, metadata=self.__list_metadata()
+        )  # Disk class
+        return self.__changed_as_dicts(session, objects)
+
+    def _list_pages_as_dicts(
+        self, request: proto.Message, session: LabelingSession
+    ) -> Iterator[Tuple[Iterator[Dict[str, Any]], str]]:
+        """Like _list_resources_as_dicts, but per page, with the token of the next page"""
+        pages = self._cloudclient().list(request, metadata=self.__list_metadata()).pages
+        for page in pages:
+            yield self.__changed_as_dicts(session, page.items), page.next_page_token
 
-    def _list_resources_as_dicts(self, request: proto.Message):
-        objects = self._cloudclient().list(request)  # Disk class
-        return cloudclient_pb_objects_to_list_of_dicts(objects)
+    def _aggregated_list_pages_as_dicts(
+        self, request: proto.Message, session: LabelingSession, scoped_list_field: str
+    ) -> Iterator[Tuple[Iterator[Dict[str, Any]], str]]:
+        """
+        List resources in all zones with one aggregatedList call. Pages are fetched
+        lazily, so resources are yielded as each page arrives.
+        :param scoped_list_field: the field of each per-scope list that holds the resources,
+        e.g. "instances". Partial-response fields are not used here, since the resources
+        are nested in a map keyed by scope.
+        :return for each page, its resources and the token of the next page
+        """
+        for page in self._cloudclient().aggregated_list(request).pages:
+            # Keys are like "zones/us-east1-b" or "regions/us-east1". Only zonal resources
+            # are handled here, as with the per-zone listing.
+            zonal = [
+                (scope, scoped_list)
+                for scope, scoped_list in page.items.items()
+                if scope.startswith("zones/")
+            ]
+            # With return_partial_success, scopes that could not be listed have a warning
+            # (e.g. UNREACHABLE) instead of failing the call; empty ones have NO_RESULTS_ON_PAGE
+            for scope, scoped_list in zonal:
+                if (
+                    "warning" in scoped_list
+                    and scoped_list.warning.code != "NO_RESULTS_ON_PAGE"
+                ):
+                    self._on_unlisted_scope(session, scope, scoped_list.warning)
+            objects = (
+                o
+                for _, scoped_list in zonal
+                for o in getattr(scoped_list, scoped_list_field)
+            )
+            yield self.__changed_as_dicts(session, objects), page.next_page_token
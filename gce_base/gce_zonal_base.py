@@ -2,21 +2,40 @@ import logging
 import threading
 from abc import ABCMeta, abstractmethod
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from functools import lru_cache
-from typing import Dict, Optional
+from contextlib import contextmanager
+from typing import Dict, Optional, Iterator, Set, Tuple
 
 from gce_base.gce_base import GceBase
+from labeling_session import LabelingSession
+from util import zone_usage
+from util.config_utils import gce_aggregated_list
 from util.gcp import gcp_utils
 from util.gcp.gcp_utils import add_loaded_lib
-from util.utils import timing
+from util.utils import timing, ttl_cache
 
+# Zones are added (and retired) rarely, so the list is refreshed daily
+ZONES_TTL_SECONDS = 24 * 3600
 
-class GceZonalBase(GceBase, metaclass=ABCMeta):
-    def __init__(self):
 
-        super().__init__()
-        self._write_lock = threading.Lock()
+@ttl_cache(seconds=ZONES_TTL_SECONDS, maxsize=1, stale_seconds=ZONES_TTL_SECONDS)
+def _list_zones():
+    """:return all zones, as seen by the current project; the same for all plugins"""
+    with timing("_list_zones"):
+        project_id = gcp_utils.current_project_id()
+        # Local import to avoid burdening AppEngine memory.
+        # Loading all Cloud Client libraries would be 100MB  means that
+        # the default AppEngine Instance crashes on out-of-memory even before actually serving a request.
+        from google.cloud import compute_v1
+
+        add_loaded_lib("compute_v1")
+
+        request = compute_v1.ListZonesRequest(project=project_id)
+        zones_client = compute_v1.ZonesClient()
+        zones = zones_client.list(request)
+        return [z.name for z in zones]
 
+
+class GceZonalBase(GceBase, metaclass=ABCMeta):
     @staticmethod
     @abstractmethod
     def _create_cloudclient():
@@ -25,6 +44,10 @@ class GceZonalBase(GceBase, metaclass=ABCMeta):
         should cache the result."""
         pass
 
+    @staticmethod
+    def _resource_fields():
+        return *GceBase._resource_fields(), "zone"
+
     def _gcp_zone(self, gcp_object):
         """Method dynamically called in generating labels, so don't change name"""
         try:
@@ -42,40 +65,156 @@ class GceZonalBase(GceBase, metaclass=ABCMeta):
             logging.exception("")
             return None
 
-    @lru_cache(maxsize=1)
-    def _all_zones(self):
+    @staticmethod
+    def _all_zones():
+        return _list_zones()
 
-        with timing("_all_zones"):
-            project_id = gcp_utils.current_project_id()
-            # Local import to avoid burdening AppEngine memory.
-            # Loading all Cloud Client libraries would be 100MB  means that
-            # the default AppEngine Instance crashes on out-of-memory even before actually serving a request.
-            from google.cloud import compute_v1
+    def _on_listed(self, session: LabelingSession, o):
+        zones = session.zones_seen
+        if zones is not None and o.zone:
+            zones.add(o.zone.split("/")[-1])
 
-            add_loaded_lib("compute_v1")
+    def _on_unlisted_scope(self, session: LabelingSession, scope: str, warning):
+        logging.warning(
+            "%s in %s not listed in %s: %s",
+            type(self).__name__,
+            session.project_id,
+            scope,
+            warning.code,
+        )
+        if session.zones_unlisted is not None:
+            session.zones_unlisted.add(scope.split("/")[-1])
 
-            request = compute_v1.ListZonesRequest(project=project_id)
-            zones_client = compute_v1.ZonesClient()
-            zones = zones_client.list(request)
-            return [z.name for z in zones]
+    @staticmethod
+    @contextmanager
+    def __recording_zones(session: LabelingSession) -> Iterator[Set[str]]:
+        """
+        Yields the set of zones in which resources are listed in the session, meanwhile.
+        Zones that could not be listed are recorded in session.zones_unlisted.
+        """
+        zones = set()
+        session.zones_seen = zones
+        session.zones_unlisted = set()
+        try:
+            yield zones
+        finally:
+            session.zones_seen = None
+            session.zones_unlisted = None
 
-    def label_all(self, project_id):
+    def label_all(self, project_id, cursor=None, deadline=None):
+        """
+        The cursor is either the page token of the aggregated listing, or, in per-zone
+        listing, the zones to list and those of them that were already done.
+        """
+        cursor = cursor or {}
         with timing(f"label_all {type(self).__name__} in {project_id}"):
-            self.__label_by_zones(project_id, self._all_zones())
-            if self.counter > 0:
-                self.do_batch()
+            with self.labeling_session(project_id, deadline=deadline) as session:
+                if gce_aggregated_list() and "zones_done" not in cursor:
+                    next_cursor = self.__label_aggregated(
+                        session, cursor.get("page_token"), deadline
+                    )
+                else:
+                    next_cursor = self.__label_by_zones(
+                        session,
+                        cursor.get("zones"),
+                        cursor.get("zones_done", []),
+                        deadline,
+                    )
+        return next_cursor
+
+    def __label_aggregated(self, session, page_token, deadline) -> Optional[Dict]:
+        """
+        Label resources of all zones, listed with a single aggregatedList call (rather than
+        one list call per zone, most of which return nothing).
+        If the aggregated listing fails, fall back to per-zone listing.
+        Resources already labeled before the failure are then labeled again, which is harmless.
+        A complete listing is a full sweep for the zone-usage index, unless some zones
+        could not be listed (with return_partial_success, the call then succeeds anyway).
+        """
+        project_id = session.project_id
+        try:
+            with self.__recording_zones(session) as zones_seen:
+                pages = self._aggregated_list_all(session, page_token)
+                next_cursor = self._label_pages(session, pages, deadline)
+                all_listed = not session.zones_unlisted
+            if page_token is None and next_cursor is None and all_listed:
+                zone_usage.record_full_sweep(
+                    type(self).__name__, project_id, zones_seen
+                )
+            return next_cursor
+        except Exception:
+            logging.exception(
+                "Aggregated listing of %s in %s failed; falling back to per-zone listing",
+                type(self).__name__,
+                project_id,
+            )
+            return self.__label_by_zones(session, None, [], deadline)
+
+    def __label_by_zones(self, session, zones, zones_done, deadline) -> Optional[Dict]:
+        """
+        List the zones that held resources at the last full sweep, as recorded
+        in the zone-usage index, or all zones if there is no recent record.
+        :param zones: the zones chosen when this sweep started, if it is being continued.
+        They are kept rather than chosen anew, since the zone-usage index may have changed
+        meanwhile, and zones not yet done could then be skipped.
+        """
+        project_id = session.project_id
+        if zones is not None:
+            return self.__label_zones(session, zones, zones_done, deadline)[0]
+        active_zones = zone_usage.active_zones(type(self).__name__, project_id)
+        if active_zones is None:
+            with self.__recording_zones(session) as zones_seen:
+                next_cursor, all_listed = self.__label_zones(
+                    session, self._all_zones(), zones_done, deadline
+                )
+            if not zones_done and next_cursor is None and all_listed:
+                zone_usage.record_full_sweep(
+                    type(self).__name__, project_id, zones_seen
+                )
+            return next_cursor
+        else:
+            return self.__label_zones(session, active_zones, zones_done, deadline)[0]
+
+    def __label_zones(
+        self, session, zones_to_list, zones_done, deadline
+    ) -> Tuple[Optional[Dict], bool]:
+        """
+        :return the cursor, and whether all zones were listed without error. A zone whose
+        listing failed is not done, so a continuation lists it again; but it does not by
+        itself call for a continuation, lest a zone that keeps failing be retried forever.
+        """
+        done = set(zones_done)
+        failed = set()
+        done_lock = threading.Lock()
 
-    def __label_by_zones(self, project_id, zones):
         def label_one_zone(zone):
             # with timing(
-            #     f"zone {zone}, label_all {type(self).__name__} in {project_id}"
+            #     f"zone {zone}, label_all {type(self).__name__} in {session.project_id}"
             # ):
-            for resource in self._list_all(project_id, zone):
-                try:
-                    self.label_resource(resource, project_id)
-                except Exception:
-                    logging.exception("in label_one_zone")
+            if self._out_of_time(deadline):
+                return
+            # A zone that runs out of time is not done, and is listed again on resumption
+            complete = True
+            try:
+                for resource in self._list_all(session, zone):
+                    if self._out_of_time(deadline):
+                        complete = False
+                        break
+                    try:
+                        self.label_resource(resource, session)
+                    except Exception:
+                        logging.exception("in label_one_zone")
+            except Exception:
+                logging.exception("Listing zone %s failed", zone)
+                complete = False
+                with done_lock:
+                    failed.add(zone)
+            finally:
+                if complete:
+                    with done_lock:
+                        done.add(zone)
 
+        zones = [z for z in zones_to_list if z not in done]
         with ThreadPoolExecutor(max_workers=8) as executor:
             futs = [executor.submit(label_one_zone, zone) for zone in zones]
             for future in as_completed(futs):
@@ -84,6 +223,13 @@ class GceZonalBase(GceBase, metaclass=ABCMeta):
                 except Exception:
                     logging.exception("Error getting result for future")
 
+        all_listed = not failed
+        if all(z in done or z in failed for z in zones):
+            return None, all_listed
+        else:
+            next_cursor = {"zones": list(zones_to_list), "zones_done": sorted(done)}
+            return next_cursor, all_listed
+
     def get_gcp_object(self, log_data: Dict) -> Optional[Dict]:
         try:
             name = log_data["protoPayload"]["resourceName"]
@@ -101,6 +247,19 @@ class GceZonalBase(GceBase, metaclass=ABCMeta):
     def _get_resource(self, project_id, zone, name):
         pass
 
+    def _refetch_resource(self, gcp_object: Dict, project_id: str) -> Optional[Dict]:
+        return self._get_resource(
+            project_id, self._gcp_zone(gcp_object), gcp_object["name"]
+        )
+
+    @abstractmethod
+    def _list_all(self, session: LabelingSession, zone):
+        pass
+
     @abstractmethod
-    def _list_all(self, project_id, zone):
+    def _aggregated_list_all(
+        self, session: LabelingSession, page_token: Optional[str] = None
+    ) -> Iterator[Tuple[Iterator[Dict], str]]:
+        """List resources across all zones, each including its zone, page by page
+        (see _aggregated_list_pages_as_dicts)"""
         pass
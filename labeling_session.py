@@ -0,0 +1,52 @@
+import threading
+from collections import Counter
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Set, Tuple
+
+from util.label_state import LabelState
+
+# A label update in a batch: the resource, and the attempt (1 for the first)
+Task = Tuple[Dict, int]
+
+
+class LabelingSession:
+    """
+    The state of one labeling request (like a do_label or a label_one) by one plugin
+    in one project: the batch being filled, with its tasks and stats, the batches that were
+    sent, and the tasks to retry.
+    It also holds the label state of the project, the count of resources processed,
+    and the zones in which resources were listed.
+    Plugins are singletons, shared by the concurrent requests of an instance. Each request
+    labels through its own session, so that requests never send, reset or wait for each
+    other's batches, nor use each other's state, even in the same project.
+    Get a session with Plugin.labeling_session.
+    """
+
+    def __init__(self, project_id: str, deadline: Optional[float] = None):
+        self.project_id = project_id
+        # Epoch-seconds after which labeling should stop, as in Plugin.label_all
+        self.deadline = deadline
+        # Guards the batch, counter and batch_tasks, which several threads may add to,
+        # e.g. one per zone
+        self.lock = threading.Lock()
+        self.batch = None
+        self.counter = 0
+        # For each request_id in the batch
+        self.batch_tasks: Dict[str, Task] = {}
+        self.batch_stats = Counter()
+        # Guards the fields below, which sender threads update
+        self.sender_lock = threading.Lock()
+        self.sent_batches: Set[Future] = set()
+        # Tasks of executed batches to retry, with the reason
+        self.retries: List[Tuple[Task, str]] = []
+        # Totals over the batches of the session: ok, failed, transient, stale
+        self.stats = Counter()
+        # Set if a state store is configured, to skip resources unchanged since the last run
+        self.label_state: Optional[LabelState] = None
+        # Resources processed, whether labeled or found to be correctly labeled already
+        self.count_lock = threading.Lock()
+        self.resource_count = 0
+        # Set while recording the zones in which resources are listed (see GceZonalBase)
+        self.zones_seen: Optional[Set[str]] = None
+        # Meanwhile also, the zones that could not be listed
+        self.zones_unlisted: Optional[Set[str]] = None
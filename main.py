@@ -3,6 +3,10 @@
 import sys
 
 print("Initializing ", file=sys.stderr)
+# Before the other imports, so that they are all profiled, if enabled
+from util import import_profile
+
+import_profile.install()
 from util.utils import init_logging, sort_dict
 
 # Must init logging before any library code writes logs (which would then just override our config)
@@ -10,12 +14,9 @@ init_logging()
 
 import flask
 from flask import Response
-from google.auth.transport import requests
-from google.oauth2 import id_token
 from util.gcp.gcp_utils import (
     increment_invocation_count,
     count_invocations_by_path,
-    get_project,
     current_project_id,
 )
 from util.gcp.detect_gae import detect_gae
@@ -26,9 +27,9 @@ if detect_gae():
 
     app.wsgi_app = google.appengine.api.wrap_wsgi_app(app.wsgi_app)
 
-from functools import lru_cache
-
-from typing import Dict, Type, List
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Type, List, Iterator, Optional
 
 import time
 
@@ -39,8 +40,8 @@ import logging
 import os
 
 from plugin import Plugin, PluginHolder
-from util import pubsub_utils, utils, config_utils
-from util.gcp import gcp_utils
+from util import pubsub_utils, utils, config_utils, project_stats
+from util.gcp import gcp_utils, project_metadata
 from util.gcp.gcp_utils import (
     detect_gae,
     is_appscript_project,
@@ -49,6 +50,9 @@ from util.gcp.gcp_utils import (
     enable_cloudprofiler,
 )
 
+from util.dedup_cache import DedupCache, PENDING
+from util.deferred_queue import LocalDeferredQueue, PubSubDeferredQueue
+from util.gcp.jwt_verifier import IdTokenVerifier
 from util.config_utils import (
     is_project_enabled,
     iris_homepage_text,
@@ -57,6 +61,12 @@ from util.utils import log_time, timing
 
 ENABLE_PROFILER = False
 
+# Small projects are packed into one do_label message up to about this many resources,
+# as counted in the last run
+PACK_RESOURCE_TARGET = 200
+# How many projects of a pack are labeled at a time
+PACK_WORKERS = 4
+
 # Profiler initialization. It starts a daemon thread which continuously collects and uploads profiles.
 if detect_gae() and ENABLE_PROFILER:
     enable_cloudprofiler()
@@ -72,6 +82,22 @@ logging.info(
 
 PluginHolder.init()
 
+# Caches Google's certificates and verified tokens, so most pushes are verified without an outbound request
+__id_token_verifier = IdTokenVerifier()
+
+# Shared across App Engine instances through Memcache; just in-process in local development
+__label_one_dedup = DedupCache(
+    config_utils.label_one_dedup_seconds(), shared=detect_gae()
+)
+
+# For resources that are labeled on creation only once ready. Pub/Sub cannot push to
+# a local development server, so there the queue is in-process.
+__deferred_queue = (
+    PubSubDeferredQueue()
+    if detect_gae()
+    else LocalDeferredQueue(lambda data: __label_deferred_0(data))
+)
+
 
 @app.route("/")
 def index():
@@ -82,6 +108,7 @@ def index():
         logging.info(
             "index(); invocations of GAE instance : %s", count_invocations_by_path()
         )
+        logging.info("index(); caches of GAE instance: %s", utils.ttl_cache_stats())
         return Response(msg, mimetype="text/plain", status=200)
 
 
@@ -90,6 +117,8 @@ def warmup():
     increment_invocation_count("warmup")
     with gae_memory_logging("warmup"):
         logging.info("warmup() called")
+        with timing("warm up plugins"):
+            PluginHolder.warm_up()
 
     return "", 200, {}
 
@@ -128,10 +157,14 @@ def __label_multiple_resource_types(label_all_types: bool=False):
     assert label_all_types is not None
     try:
         enabled_projects = __get_enabled_projects()
-        __send_pubsub_per_projectplugin(
+        result = __send_pubsub_per_projectplugin(
             enabled_projects, label_all_types=label_all_types
         )
-        # All errors are actually caught, logged and ignored *before* this point,
+        if result.failures:
+            # Cloud Scheduler retries on error; projects whose messages were sent
+            # are then relabeled, which is harmless.
+            return f"Error: {result}", 500
+        # Other errors are caught, logged and ignored *before* this point,
         # since most errors are unrecoverable.
         return "OK", 200
     except Exception:
@@ -139,7 +172,6 @@ def __label_multiple_resource_types(label_all_types: bool=False):
         return "Error", 500
 
 
-@lru_cache(maxsize=1)
 def __get_enabled_projects() -> List:
     configured_as_enabled = config_utils.enabled_projects()
     if configured_as_enabled:
@@ -164,34 +196,104 @@ def __get_enabled_projects() -> List:
     return enabled_projs
 
 
-def __send_pubsub_per_projectplugin(configured_projects: List, label_all_types: bool):
-    msg_count = 0
-    for project_id in configured_projects:
-        for plugin_cls in PluginHolder.plugins:
-
-            if (
-                not plugin_cls.is_labeled_on_creation()
-                or plugin_cls.relabel_on_cron()
-                or label_all_types
-            ):
-                pubsub_utils.publish(
-                    msg=json.dumps(
-                        {"project_id": project_id, "plugin": plugin_cls.__name__}
-                    ),
-                    topic_id=pubsub_utils.schedulelabeling_topic(),
-                )
-
-                logging.info(
-                    "Sent do_label message for %s , %s",
-                    project_id,
-                    plugin_cls.__name__,
-                )
-            msg_count += 1
+def __send_pubsub_per_projectplugin(
+    configured_projects: List, label_all_types: bool
+) -> pubsub_utils.PublishResult:
+    plugin_classes = [
+        plugin_cls
+        for plugin_cls in PluginHolder.plugin_classes()
+        if (
+            not plugin_cls.is_labeled_on_creation()
+            or plugin_cls.relabel_on_cron()
+            or label_all_types
+        )
+    ]
+    if config_utils.do_label_max_pack_size() > 1:
+        counts = project_stats.resource_counts(
+            configured_projects, [plugin_cls.__name__ for plugin_cls in plugin_classes]
+        )
+    else:
+        counts = {}
+    if config_utils.is_copying_labels_from_project():
+        try:
+            project_metadata.prefetch(configured_projects)
+        except Exception:
+            # do_label then gets the projects one by one
+            logging.exception("Cannot prefetch project labels")
+
+    def msgs():
+        for plugin_cls in plugin_classes:
+            plugin_name = plugin_cls.__name__
+            plugin_counts = {
+                project_id: counts[project_id][plugin_name]
+                for project_id in configured_projects
+                if plugin_name in counts.get(project_id, {})
+            }
+            for pack in __pack_projects(configured_projects, plugin_counts):
+                yield __do_label_msg(plugin_name, pack)
+
+    result = pubsub_utils.publish_many(
+        msgs(), topic_id=pubsub_utils.schedulelabeling_topic()
+    )
     logging.info(
-        "schedule() sent %d messages to label %d projects",
-        msg_count,
+        "schedule() sent do_label messages to label %d projects: %s",
         len(configured_projects),
+        result,
     )
+    return result
+
+
+def __pack_projects(project_ids: List[str], counts: Dict[str, int]) -> Iterator[List]:
+    """
+    Split projects into packs for do_label, each with up to about PACK_RESOURCE_TARGET
+    resources, as counted in the last run. Projects without a count are packed as if empty;
+    if they turn out to be large, do_label resumes them in further messages.
+    """
+    max_pack_size = config_utils.do_label_max_pack_size()
+    pack = []
+    pack_resources = 0
+    for project_id in project_ids:
+        count = counts.get(project_id, 0)
+        if max_pack_size == 1 or count >= PACK_RESOURCE_TARGET:
+            yield [project_id]
+            continue
+        if pack and (
+            len(pack) >= max_pack_size or pack_resources + count > PACK_RESOURCE_TARGET
+        ):
+            yield pack
+            pack = []
+            pack_resources = 0
+        pack.append(project_id)
+        pack_resources += count
+    if pack:
+        yield pack
+
+
+def __do_label_msg(
+    plugin_class_name: str,
+    project_ids: List[str],
+    cursor: Optional[Dict] = None,
+    resources_so_far: int = 0,
+) -> str:
+    """
+    A single project is sent as project_id, as before packing was introduced,
+    with a cursor if resuming; a pack of projects as project_ids.
+    If labels are copied from projects, the labels of the projects are included
+    where they are cached, so that do_label need not get the projects.
+    """
+    if len(project_ids) == 1:
+        msg = {"project_id": project_ids[0], "plugin": plugin_class_name}
+        if cursor:
+            msg["cursor"] = cursor
+            msg["resources_so_far"] = resources_so_far
+    else:
+        assert not cursor, "Only single projects are resumed from a cursor"
+        msg = {"project_ids": project_ids, "plugin": plugin_class_name}
+    if config_utils.is_copying_labels_from_project():
+        project_labels = project_metadata.cached(project_ids)
+        if project_labels:
+            msg["project_labels"] = project_labels
+    return json.dumps(msg)
 
 
 @app.route("/label_one", methods=["POST"])
@@ -211,46 +313,35 @@ def label_one():
             """
             PubSub push endpoint for messages from the Log Sink
             """
-            # Performance question: There are multiple log lines for each object-creation, for example,
-            # one for request and one for response. So, we may be labeling each object multiple times,
-            # which is a waste of resources.
-            #
-            # Or maybe not. Maybe the first PubSub-triggered action fails, because the resource is not initialized, and
-            # then the second one succeeds; need to check that.
+            # There are multiple log lines for each object-creation, for example,
+            # one for request and one for response. To avoid labeling each object multiple times,
+            # we drop messages for a resource and method that was already labeled within the dedup window.
+            # The key is claimed before the resource is fetched, so that near-simultaneous duplicates
+            # are not handled too. It is released if labeling fails, since the first PubSub-triggered
+            # action may fail, because the resource is not initialized, and then the second one succeeds.
 
             data = __extract_pubsub_content()
 
             method_from_log = data["protoPayload"]["methodName"]
-            for plugin_cls in PluginHolder.plugins.keys():
-                method_names = plugin_cls.method_names()
-
-                for supported_method in method_names:
-                    if supported_method.lower() in method_from_log.lower():
-                        if plugin_cls.is_labeled_on_creation():
-                            logging.info(
-                                "plugin_cls %s, with method %s",
-                                plugin_cls.__name__,
-                                method_from_log,
-                            )
-                            __label_one_0(data, plugin_cls)
-
-                        plugins_found.append(
-                            plugin_cls.__name__
-                        )  # Append it even if not used due to is_labeled_on_creation False
-
-            if not plugins_found:
-                logging.info(
-                    "(This message does not indicate an error if the plugin is disabled.)"
-                    + " No plugins found for %s. Enabled plugins are %s",
-                    method_from_log,
-                    config_utils.enabled_plugins(),
-                )
+            dedup_key = __dedup_key(data)
+            earlier_claim = __label_one_dedup.claim(dedup_key)
+            if earlier_claim == PENDING:
+                # PubSub redelivers later, once the other request has labeled, or failed
+                logging.info("label_one for %s is in progress", dedup_key)
+                return "In progress", 503
+            elif earlier_claim is not None:
+                logging.info("Dropping duplicate label_one for %s", dedup_key)
+                return "OK", 200
+
+            labeled = False
+            try:
+                labeled = __label_one_by_method(data, method_from_log, plugins_found)
+            finally:
+                if labeled:
+                    __label_one_dedup.mark_done(dedup_key)
+                else:
+                    __label_one_dedup.release(dedup_key)
 
-            if len(plugins_found) > 1:
-                raise Exception(
-                    "Error: Multiple plugins found %s for %s"
-                    % (plugins_found, method_from_log)
-                )
             logging.info("OK for label_one %s", method_from_log)
             # All errors are actually caught before this point,
             # since most errors are unrecoverable.
@@ -261,6 +352,111 @@ def label_one():
             return "Error", 500
 
 
+def __label_one_by_method(data, method_from_log, plugins_found: List[str]) -> bool:
+    """:return True if the resource was labeled, or put in the deferred queue"""
+    plugin_cls = PluginHolder.plugin_cls_for_method(method_from_log)
+    if plugin_cls is None:
+        logging.info(
+            "(This message does not indicate an error if the plugin is disabled.)"
+            + " No plugins found for %s. Enabled plugins are %s",
+            method_from_log,
+            config_utils.enabled_plugins(),
+        )
+        return False
+    plugins_found.append(plugin_cls.__name__)
+    if not plugin_cls.is_labeled_on_creation():
+        return False
+    logging.info(
+        "plugin_cls %s, with method %s",
+        plugin_cls.__name__,
+        method_from_log,
+    )
+    if plugin_cls.label_on_creation_deferred():
+        return __defer_label_one(data, plugin_cls)
+    else:
+        return __label_one_0(data, plugin_cls)
+
+
+def __defer_label_one(data, plugin_cls: Type[Plugin]) -> bool:
+    """:return True if the log message was put in the deferred queue"""
+    project_id = data["resource"]["labels"]["project_id"]
+    if not is_project_enabled(project_id):
+        logging.info(
+            "Skipping label_one(%s) in unsupported project %s",
+            plugin_cls.__name__,
+            project_id,
+        )
+        return False
+    logging.info(
+        "Deferring label_one(%s) until ready: %s",
+        plugin_cls.__name__,
+        data["protoPayload"]["resourceName"],
+    )
+    __deferred_queue.defer(data)
+    return True
+
+
+@app.route("/label_deferred", methods=["POST"])
+def label_deferred():
+    """
+    Message received from PubSub for a resource that label_one deferred until it is ready.
+    While it is not, the error response has PubSub redeliver the message later,
+    with the backoff of the retry policy of the subscription.
+    """
+    logging.info("label_deferred called")
+    increment_invocation_count("label_deferred")
+    ok = __check_pubsub_jwt()
+    if not ok:
+        return "JWT Failed", 400
+
+    with gae_memory_logging("label_deferred"):
+        data = {}
+        try:
+            data = __extract_pubsub_content()
+            if __label_deferred_0(data):
+                return "OK", 200
+            else:
+                return "Not ready", 503
+        except Exception:
+            project_id = data.get("resource", {}).get("labels", {}).get("project_id")
+            logging.exception("Error on label_deferred in %s", project_id)
+            return "Error", 500
+
+
+def __label_deferred_0(data) -> bool:
+    """:return False if the resource is not yet ready, so that labeling is to be retried"""
+    method_from_log = data["protoPayload"]["methodName"]
+    plugin_cls = PluginHolder.plugin_cls_for_method(method_from_log)
+    if plugin_cls is None:
+        logging.info("No plugins found for deferred %s", method_from_log)
+        return True
+    plugin = PluginHolder.get_plugin_instance(plugin_cls)
+    gcp_object = plugin.get_gcp_object(data)
+    if gcp_object is None or not plugin.is_ready_to_label(gcp_object):
+        logging.info(
+            "Not yet ready to label %s", data["protoPayload"].get("resourceName")
+        )
+        return False
+    project_id = data["resource"]["labels"]["project_id"]
+    with plugin.labeling_session(project_id, use_label_state=False) as session:
+        plugin.label_resource(gcp_object, session)
+    # Failed label updates are retried too
+    return not session.stats["failed"]
+
+
+def __dedup_key(data) -> str:
+    proto_payload = data["protoPayload"]
+    # For CreateSubscription, resourceName is the topic; the subscription is in request.name
+    request_name = (proto_payload.get("request") or {}).get("name", "")
+    return " ".join(
+        (
+            proto_payload.get("resourceName", ""),
+            str(request_name),
+            proto_payload["methodName"],
+        )
+    )
+
+
 def __check_pubsub_jwt():
     try:
         # TODO The sample https://github.com/GoogleCloudPlatform/python-docs-samples/blob/ff4c1d55bb5b6995c63383469535604002dc9ba2/appengine/standard_python3/pubsub/main.py#L69
@@ -270,7 +466,7 @@ def __check_pubsub_jwt():
         bearer_token = flask.request.headers.get("Authorization")
         token = bearer_token.split(" ")[1]
 
-        claim = id_token.verify_oauth2_token(token, requests.Request())
+        claim = __id_token_verifier.verify(token)
 
         # Here is an example claim:  { "aud": "https://iris3-dot-myproj.appspot.com/label_one?token=xxxxxxxxx",
         #     "azp": "1125239305332910191520",
@@ -295,7 +491,8 @@ def __check_pubsub_jwt():
     return True
 
 
-def __label_one_0(data, plugin_cls: Type[Plugin]):
+def __label_one_0(data, plugin_cls: Type[Plugin]) -> bool:
+    """:return True if the resource was labeled, with no failed label updates"""
     plugin = PluginHolder.get_plugin_instance(plugin_cls)
     gcp_object = plugin.get_gcp_object(data)
     if gcp_object is not None:
@@ -309,8 +506,9 @@ def __label_one_0(data, plugin_cls: Type[Plugin]):
                 "Will label_one(): %s ",
                 data["protoPayload"]["resourceName"],
             )
-            plugin.label_resource(gcp_object, project_id)
-            plugin.do_batch()
+            with plugin.labeling_session(project_id, use_label_state=False) as session:
+                plugin.label_resource(gcp_object, session)
+            return not session.stats["failed"]
         else:
             msg = (
                 f"Skipping label_one({plugin_cls.__name__}) in unsupported "
@@ -326,6 +524,7 @@ def __label_one_0(data, plugin_cls: Type[Plugin]):
             + "e.g. for BQ datasets where serviceData is missing), based on %s",
             utils.shorten(str(data.get("resource")), 300),
         )
+    return False
 
 
 def __extract_pubsub_content() -> Dict:
@@ -352,7 +551,7 @@ def __extract_pubsub_content() -> Dict:
 @app.route("/do_label", methods=["POST"])
 def do_label():
     """Receives a push message from PubSub, sent from schedule() above,
-    and labels all objects of a given plugin and project_id.
+    and labels all objects of a given plugin in a project_id, or in a pack of project_ids.
     """
     increment_invocation_count("do_label")
     logging.info("do_label called")
@@ -362,11 +561,14 @@ def do_label():
 
     with gae_memory_logging("do_label"):
 
-        project_id = ""  # set up variables to allow logging in Exception block at end
+        project_ids = []  # set up variables to allow logging in Exception block at end
         plugin_class_name = ""
         try:
             data = __extract_pubsub_content()
             plugin_class_name = data["plugin"]
+            project_ids = data.get("project_ids") or [data["project_id"]]
+            if "project_labels" in data:
+                project_metadata.put(data["project_labels"])
 
             plugin = PluginHolder.get_plugin_instance_by_name(plugin_class_name)
             if not plugin:
@@ -376,16 +578,10 @@ def do_label():
                     config_utils.enabled_plugins(),
                 )
             else:
-                project_id = data["project_id"]
-                with timing(f"do_label {plugin_class_name} {project_id}"):
-                    logging.info(
-                        "do_label() for %s in %s",
-                        plugin.__class__.__name__,
-                        project_id,
-                    )
-                    plugin.label_all(project_id)
+                if not __label_projects(plugin, project_ids, data):
+                    return "Error", 500
                 logging.info(
-                    "Returning OK on do_label %s %s", plugin_class_name, project_id
+                    "Returning OK on do_label %s %s", plugin_class_name, project_ids
                 )
 
             return "OK", 200
@@ -393,10 +589,116 @@ def do_label():
             # All errors are actually caught, logged (and ignored in a loop, or else thrown)  *before* this point
             # However, Subscription gets "InternalServerError"" "InactiveRpcError" on occasion
             #  so retry could be relevant.
-            logging.exception("Error on do_label %s %s", plugin_class_name, project_id)
+            logging.exception("Error on do_label %s %s", plugin_class_name, project_ids)
             return "Error", 500
 
 
+def __label_projects(plugin: Plugin, project_ids: List[str], data: Dict) -> bool:
+    """
+    Label all objects of the plugin's type in each project, a few projects at a time.
+    Projects that run out of the time budget are resumed in new do_label messages, and so are
+    those that were not started in time. Resource counts of completed projects are recorded
+    for packing in the next run.
+    :return False if labeling failed in all projects, so that PubSub redelivers the message
+    """
+    plugin_class_name = type(plugin).__name__
+    cursor = data.get("cursor")  # Only for a single project
+    resources_so_far = data.get("resources_so_far", 0)
+    deadline = time.time() + config_utils.do_label_time_budget_seconds()
+
+    def log_start(project_id):
+        logging.info(
+            "do_label() for %s in %s%s",
+            plugin_class_name,
+            project_id,
+            f", resuming from {cursor}" if cursor else "",
+        )
+
+    def finish(project_id, next_cursor, count):
+        count += resources_so_far
+        if next_cursor:
+            __publish_continuation(plugin_class_name, project_id, next_cursor, count)
+        else:
+            project_stats.record_resource_count(project_id, plugin_class_name, count)
+
+    def label_project(project_id) -> Optional[bool]:
+        """:return False if not started, for lack of time; None on failure"""
+        if len(project_ids) > 1 and time.time() >= deadline:
+            return False
+        try:
+            with timing(f"do_label {plugin_class_name} {project_id}"):
+                log_start(project_id)
+                next_cursor, count = plugin.label_project(project_id, cursor, deadline)
+            finish(project_id, next_cursor, count)
+            return True
+        except Exception:
+            logging.exception("Error on do_label %s %s", plugin_class_name, project_id)
+            return None
+
+    async def label_project_async(project_id, limit: asyncio.Semaphore):
+        async with limit:
+            if len(project_ids) > 1 and time.time() >= deadline:
+                return False
+            try:
+                with timing(f"do_label {plugin_class_name} {project_id}"):
+                    log_start(project_id)
+                    next_cursor, count = await plugin.label_project_async(
+                        project_id, cursor, deadline
+                    )
+                await asyncio.to_thread(finish, project_id, next_cursor, count)
+                return True
+            except Exception:
+                logging.exception(
+                    "Error on do_label %s %s", plugin_class_name, project_id
+                )
+                return None
+
+    workers = PACK_WORKERS if plugin._labels_projects_concurrently() else 1
+    if config_utils.async_labeling():
+
+        async def label_all_projects():
+            limit = asyncio.Semaphore(workers)
+            return await asyncio.gather(
+                *(label_project_async(p, limit) for p in project_ids)
+            )
+
+        results = asyncio.run(label_all_projects())
+    elif len(project_ids) == 1:
+        results = [label_project(project_ids[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(label_project, project_ids))
+
+    not_started = [p for p, started in zip(project_ids, results) if started is False]
+    if not_started:
+        pubsub_utils.publish(
+            msg=__do_label_msg(plugin_class_name, not_started),
+            topic_id=pubsub_utils.schedulelabeling_topic(),
+        )
+        logging.info(
+            "Sent do_label for %s in %d projects not started in time",
+            plugin_class_name,
+            len(not_started),
+        )
+    return any(started is not None for started in results)
+
+
+def __publish_continuation(
+    plugin_class_name: str, project_id: str, cursor: Dict, resources_so_far: int
+):
+    """do_label ran out of its time budget; another do_label will resume from the cursor"""
+    pubsub_utils.publish(
+        msg=__do_label_msg(plugin_class_name, [project_id], cursor, resources_so_far),
+        topic_id=pubsub_utils.schedulelabeling_topic(),
+    )
+    logging.info(
+        "Sent do_label continuation for %s, %s from %s",
+        project_id,
+        plugin_class_name,
+        cursor,
+    )
+
+
 class FlaskException(Exception):
     status_code = 400
 
@@ -422,6 +724,7 @@ def handle_invalid_usage(error):
 
 
 logging.info(f"Coldstart took {int((time.time() - cold_start_begin) * 1000)} ms")
+import_profile.log_profile()
 
 if __name__ in ["__main__"]:
     # This is used when running locally only. When deploying to Google App
@@ -1,49 +1,93 @@
+import asyncio
 import logging
 import pkgutil
+import random
 import re
 import threading
+import time
 from abc import ABCMeta, abstractmethod
-from functools import lru_cache
-from typing import Dict, Tuple, Type, Optional
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache, partial
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Type, Optional
 
-from googleapiclient import discovery
 from googleapiclient import errors
 
+from labeling_session import LabelingSession
+from plugin_methods import METHOD_NAMES
 from util import config_utils
 from util.config_utils import (
+    filter_labeled_on_list,
     is_copying_labels_from_project,
     iris_prefix,
     specific_prefix,
 )
-from util.gcp import gcp_utils
+from util.gcp import gcp_utils, project_metadata
+from util.label_state import LabelState, resource_version
+from util.state_store import state_store
 from util.utils import (
-    methods,
     cls_by_name,
     log_time,
-    timed_lru_cache,
 )
 
 PLUGINS_MODULE = "plugins"
 
+# Methods with this prefix compute labels; the rest of the method name is the label key
+LABEL_FUNC_PFX = "_gcp_"
+
+_ILLEGAL_LABEL_VALUE_CHARS = re.compile(r"[^\w-]")
+
+# The resource counts of the labeling sessions in the label_project call that is running
+# in this thread (or task), if any. Plugin instances are shared by concurrent requests,
+# so this is per context rather than on the instance.
+_project_resource_counts: ContextVar[Optional[List[int]]] = ContextVar(
+    "project_resource_counts", default=None
+)
+
+
+@lru_cache(maxsize=4096)  # Label values, like zones and locations, often repeat
+def _legalize_label_value(s: str) -> str:
+    """
+    Only hyphens (-), underscores (_), lowercase characters,
+    and numbers are allowed in label values. International characters are allowed.
+    """
+    return _ILLEGAL_LABEL_VALUE_CHARS.sub("_", s).lower()[:62]
+
 
 # Since subclasses are already singletons, and we are already using
 # a lot of classmethods and staticmethods, could convert this code to
 # never use instance methods, maybe  only staticmethods
 class Plugin(metaclass=ABCMeta):
     # Underlying API  max is 1000; avoid off-by-one errors
-    # We send a batch when _BATCH_SIZE or more tasks are in it, or at the end of a label_all
+    # We send a batch when it has as many tasks as the current batch size, or at the end of a labeling session.
+    # The batch size starts at _BATCH_SIZE, is halved when a batch has many transient errors or
+    # is slow, and grows back by _BATCH_SIZE_STEP with each full batch that goes well.
     _BATCH_SIZE = 990
+    _MIN_BATCH_SIZE = 10
+    _BATCH_SIZE_STEP = 50
+    _SLOW_BATCH_SECONDS = 20
+    # Failed tasks are retried up to this many times, if the error is transient or the fingerprint was stale
+    _BATCH_MAX_RETRIES = 3
+    # Full batches are executed on sender threads while listing goes on. When this many are
+    # outstanding, adding to a full batch waits.
+    _MAX_OUTSTANDING_BATCHES = 2
+    # After the deadline of labeling, do_batch waits for sent batches and retries failed tasks
+    # for at most this long, so that do_label ends within the acknowledgement deadline
+    _BATCH_DRAIN_SECONDS = 10
 
     @staticmethod
     @abstractmethod
     def _discovery_api() -> Optional[Tuple[str, str]]:
         pass
 
-    @staticmethod
-    @abstractmethod
-    def method_names():
-        """The name of the methods inside the Google REST API that indicate the creation of such resources."""
-        pass
+    @classmethod
+    def method_names(cls) -> Tuple[str, ...]:
+        """The name of the methods inside the Google REST API that indicate the creation of such resources.
+        These are declared in plugin_methods.py, so that they are known without importing the plugin.
+        """
+        return METHOD_NAMES[cls.__name__.lower()]
 
     @staticmethod
     def relabel_on_cron() -> bool:
@@ -61,13 +105,37 @@ class Plugin(metaclass=ABCMeta):
         """
         return True
 
+    @staticmethod
+    def label_on_creation_deferred() -> bool:
+        """
+        Resources that are labeled on creation, but only once they are ready, which is
+        too long after the creation is logged to just retry in label_one, should
+        override this and is_ready_to_label. label_one then parks the log message
+        in the deferred queue, which rechecks it until the resource is ready.
+        """
+        return False
+
+    def is_ready_to_label(self, gcp_object: Dict) -> bool:
+        """:return False if labels cannot yet be set, as the resource is initializing"""
+        return True
+
     @classmethod
-    @lru_cache(maxsize=1)
+    @lru_cache(maxsize=64)  # cached per class; maxsize=1 made plugins evict each other
     def _google_api_client(cls):
-
+        """
+        Built from the discovery document that is packaged with google-api-python-client,
+        rather than one fetched over the network, and without the discovery cache, which
+        does not apply to packaged documents. PluginHolder.warm_up builds these in advance.
+        """
         discovery_api = cls._discovery_api()
         if discovery_api is not None:
-            return discovery.build(*discovery_api)
+            # Local import to avoid burdening AppEngine memory at cold start,
+            # as many requests (like /schedule) do not label.
+            from googleapiclient import discovery
+
+            return discovery.build(
+                *discovery_api, static_discovery=True, cache_discovery=False
+            )
         else:
             return None
 
@@ -83,85 +151,521 @@ class Plugin(metaclass=ABCMeta):
             "Implement this if you want to use the Cloud Client libraries"
         )
 
+    @staticmethod
+    def _label_state_key_field() -> str:
+        """Field (camelCase) that uniquely identifies a resource, for the label-state cache"""
+        return "selfLink"
+
+    @staticmethod
+    def _label_state_version_fields() -> Tuple[str, ...]:
+        """Fields (camelCase) that change whenever the labels of a resource, or the values
+        they are computed from, might change. Plugins whose labels depend on
+        mutable fields (like Disks attachment) should add these fields."""
+        return "labelFingerprint", "etag", "labels"
+
+    @staticmethod
+    def _resource_fields() -> Optional[Tuple[str, ...]]:
+        """Fields (camelCase) that labeling reads from a resource, so that only
+        these are converted from Cloud Client objects; None for all fields.
+        The label-state fields are added in _projected_fields."""
+        return None
+
+    @classmethod
+    @lru_cache(maxsize=64)  # cached per class
+    def _projected_fields(cls) -> Optional[Tuple[str, ...]]:
+        declared = cls._resource_fields()
+        if declared is None:
+            return None
+        label_state_fields = (
+            cls._label_state_key_field(),
+            *cls._label_state_version_fields(),
+        )
+        return tuple(dict.fromkeys((*declared, *label_state_fields)))
+
+    @staticmethod
+    def _unlabeled_filter(label_key: str) -> Optional[str]:
+        """The filter, in the syntax of the list API, for resources without
+        the label label_key; None if the API cannot filter on labels."""
+        return None
+
+    @classmethod
+    def _list_filter(cls) -> Optional[str]:
+        """
+        If filter_labeled_on_list is configured, a filter for list calls so that
+        resources which already have the Iris name label are not fetched;
+        otherwise None.
+        Plugins that relabel on cron are not filtered, since their labels can
+        change after they were first labeled.
+        """
+        if not filter_labeled_on_list() or cls.relabel_on_cron():
+            return None
+        name_keys = [
+            key for key, func in cls._label_extractors() if func.__name__ == "_gcp_name"
+        ]
+        return cls._unlabeled_filter(name_keys[0]) if name_keys else None
+
+    @classmethod
+    def _list_fields_mask(cls) -> Optional[str]:
+        """
+        If filter_labeled_on_list is configured, the partial-response fields for
+        list calls, like "items(name,labels),nextPageToken", from _projected_fields;
+        otherwise, or if the plugin does not declare its fields, None.
+        All these fields must exist in the API's resource, or it rejects the list call.
+        """
+        fields = cls._projected_fields()
+        if not filter_labeled_on_list() or fields is None:
+            return None
+        return f"items({','.join(fields)}),nextPageToken"
+
+    @staticmethod
+    def _labels_projects_concurrently() -> bool:
+        """Whether label_all can run for several projects at once in this
+        plugin instance, as in do_label with a pack of projects"""
+        return True
+
     def __init__(self):
-        self.__init_batch_req()
+        # The batch size and the sender threads are shared by all labeling sessions
+        self.__batch_size = self._BATCH_SIZE
+        self.__batch_size_lock = threading.Lock()
+        self.__sender = ThreadPoolExecutor(
+            max_workers=self._MAX_OUTSTANDING_BATCHES,
+            thread_name_prefix=f"{type(self).__name__}-batch",
+        )
+        self.__outstanding = threading.BoundedSemaphore(self._MAX_OUTSTANDING_BATCHES)
+        # The attempt of tasks that a thread adds to a batch, > 1 only while do_batch retries
+        self.__retrying = threading.local()
+
+    def label_project(
+        self,
+        project_id,
+        cursor: Optional[Dict] = None,
+        deadline: Optional[float] = None,
+    ) -> Tuple[Optional[Dict], int]:
+        """
+        Run label_all.
+        :return the cursor returned by label_all, and the number of resources that
+        were processed, whether labeled or found to be correctly labeled already.
+        """
+        counts = []
+        token = _project_resource_counts.set(counts)
+        try:
+            next_cursor = self.label_all(project_id, cursor, deadline)
+        finally:
+            _project_resource_counts.reset(token)
+        return next_cursor, sum(counts)
+
+    async def label_project_async(
+        self,
+        project_id,
+        cursor: Optional[Dict] = None,
+        deadline: Optional[float] = None,
+    ) -> Tuple[Optional[Dict], int]:
+        """label_project, with label_all_async"""
+        counts = []
+        token = _project_resource_counts.set(counts)
+        try:
+            next_cursor = await self.label_all_async(project_id, cursor, deadline)
+        finally:
+            _project_resource_counts.reset(token)
+        return next_cursor, sum(counts)
+
+    def __count_resource(self, session: LabelingSession):
+        if self.__attempt() > 1:
+            return  # Counted on the first attempt
+        with session.count_lock:
+            session.resource_count += 1
+
+    def __label_state_context(self, project_id) -> str:
+        """Everything other than the resource itself that determines its labels"""
+        cls_name = type(self).__name__
+        project_labels = (
+            self._project_labels(project_id) if is_copying_labels_from_project() else {}
+        )
+        label_keys = [key for key, _ in self._label_extractors()]
+        return repr(
+            (
+                cls_name,
+                iris_prefix(),
+                specific_prefix(cls_name),
+                sorted(project_labels.items()),
+                label_keys,
+            )
+        )
 
-    @timed_lru_cache(seconds=600, maxsize=512)
-    def _project_labels(self, project_id) -> Dict:
+    @contextmanager
+    def labeling_session(
+        self, project_id, use_label_state=True, deadline: Optional[float] = None
+    ) -> Iterator[LabelingSession]:
+        """
+        Label through the session that this yields, as in label_all or in label_one.
+        On exit, the rest of its batch is sent, and failed tasks are retried (see do_batch).
+        :param use_label_state: if a state store is configured, resources that are unchanged
+        since they were last found to be correctly labeled can be skipped with
+        _unchanged_since_last_run. The state is saved only if labeling completes
+        without an exception.
+        :param deadline: as in label_all; bounds also the sending and retrying on exit.
+        """
+        session = LabelingSession(project_id, deadline)
+        if use_label_state and state_store() is not None:
+            session.label_state = LabelState(
+                type(self).__name__, project_id, self.__label_state_context(project_id)
+            )
+        # Counted for label_project, if it is running in this thread (or task)
+        project_counts = _project_resource_counts.get()
+        self.__new_batch(session)
         try:
-            proj = gcp_utils.get_project(project_id)
-            return proj.get("labels", {})
-        except errors.HttpError:
-            logging.exception("Failing to get labels for project {project_id}")
-            return {}
+            yield session
+        finally:
+            self.do_batch(session)
+            if session.stats:
+                logging.info(
+                    "Label updates of %s in %s: %d ok, %d failed, %d retried",
+                    type(self).__name__,
+                    project_id,
+                    session.stats["ok"],
+                    session.stats["failed"],
+                    session.stats["transient"] + session.stats["stale"],
+                )
+            if project_counts is not None:
+                project_counts.append(session.resource_count)
+        if session.label_state is not None:
+            session.label_state.save()
+
+    def __resource_version(self, gcp_object):
+        return resource_version(
+            gcp_object,
+            self._label_state_key_field(),
+            self._label_state_version_fields(),
+        )
+
+    def _unchanged_since_last_run(self, session: LabelingSession, gcp_object) -> bool:
+        """
+        :param gcp_object: a resource as a dict, or a Cloud Client object not yet converted to a dict,
+        so that unchanged resources need not be converted.
+        """
+        state = session.label_state
+        if state is None:
+            return False
+        key_and_version = self.__resource_version(gcp_object)
+        unchanged = key_and_version is not None and state.is_unchanged(*key_and_version)
+        if unchanged:
+            self.__count_resource(session)
+        return unchanged
+
+    def __mark_correctly_labeled(self, session: LabelingSession, gcp_object):
+        state = session.label_state
+        if state is None:
+            return
+        key_and_version = self.__resource_version(gcp_object)
+        if key_and_version is not None:
+            state.mark_correctly_labeled(*key_and_version)
+
+    @staticmethod
+    def _project_labels(project_id) -> Dict:
+        return project_metadata.project_labels(project_id)
+
+    @classmethod
+    @lru_cache(maxsize=64)  # cached per class
+    def _label_extractors(cls) -> Tuple[Tuple[str, Callable], ...]:
+        """
+        The label key and the function that computes the label value, for each _gcp_ method.
+        Computed once per class (in PluginHolder.plugin_cls_by_name), rather than by scanning
+        the methods for each object that is labeled.
+        """
+        general_pfx = iris_prefix()
+        assert general_pfx is not None
+        specific_pfx = specific_prefix(cls.__name__)
+        pfx = specific_pfx if specific_pfx is not None else general_pfx
+        pfx_full = pfx + "_" if pfx else ""
+        return tuple(
+            (pfx_full + name[len(LABEL_FUNC_PFX) :], getattr(cls, name))
+            for name in dir(cls)
+            if name.startswith(LABEL_FUNC_PFX) and callable(getattr(cls, name))
+        )
 
     def __iris_labels(self, gcp_object) -> Dict[str, str]:
-        func_name_pfx = "_gcp_"
-
-        def legalize_value(s):
-            """
-            Only hyphens (-), underscores (_=None), lowercase characters,
-            and numbers are allowed in label values. International characters are allowed.
-            """
-            label_chars = re.compile(r"[\w\d_-]")  # cached
-            return "".join(c if label_chars.match(c) else "_" for c in s).lower()[:62]
-
-        def value(func, gcp_obj):
-            return legalize_value(func(gcp_obj))
-
-        def key(func) -> str:
-            general_pfx = iris_prefix()
-            assert general_pfx is not None
-            specific_pfx = specific_prefix(type(self).__name__)
-            pfx = specific_pfx if specific_pfx is not None else general_pfx
-            pfx_full = pfx + "_" if pfx else ""
-            return pfx_full + func.__name__[len(func_name_pfx) :]
-
-        # noinspection PyTypeChecker
-        return {key(f): value(f, gcp_object) for f in methods(self, func_name_pfx)}
-
-    # noinspection PyUnusedLocal
-    def __batch_callback(self, request, response, exception):
-        if exception is not None:
+        return {
+            key: _legalize_label_value(func(self, gcp_object))
+            for key, func in self._label_extractors()
+        }
+
+    def _refetch_resource(self, gcp_object: Dict, project_id: str) -> Optional[Dict]:
+        """
+        Get the resource again, e.g. after its label fingerprint turned out to be stale,
+        so that its labels can be updated with the current fingerprint.
+        :return None if the plugin does not support this, or the resource was not found
+        """
+        return None
+
+    def __attempt(self) -> int:
+        return getattr(self.__retrying, "attempt", 1)
+
+    def _add_to_batch(self, session: LabelingSession, request, gcp_object: Dict):
+        """
+        Add a label update to the batch of the session, which is sent to a sender thread
+        once it is full. Tasks that fail are retried in do_batch by calling
+        label_resource again.
+        """
+        with session.lock:
+            request_id = gcp_utils.generate_uuid()
+            session.batch.add(request, request_id=request_id)
+            session.batch_tasks[request_id] = (gcp_object, self.__attempt())
+            session.counter += 1
+            if session.counter >= self.__batch_size:
+                self.__send_batch(session)
+
+    @staticmethod
+    def __retry_reason(exception) -> Optional[str]:
+        """:return "stale" if the fingerprint (or etag) was outdated, "transient" if
+        the same request may succeed later, or None if retrying would not help"""
+        if not isinstance(exception, errors.HttpError):
+            return None
+        status = exception.resp.status
+        msg = str(exception).lower()
+        if status == 412 or "fingerprint" in msg:
+            return "stale"
+        if status == 429 or status >= 500:
+            return "transient"
+        if status == 403 and ("ratelimitexceeded" in msg or "rate limit" in msg):
+            return "transient"
+        return None
+
+    def __batch_callback(
+        self, session, tasks, stats, request_id, response, exception
+    ):
+        """Called on the sender thread, with the tasks and stats of its batch"""
+        task = tasks.pop(request_id, None)
+        if exception is None:
+            stats["ok"] += 1
+            return
+        reason = self.__retry_reason(exception)
+        if task is not None and reason and task[1] <= self._BATCH_MAX_RETRIES:
+            stats[reason] += 1
+            with session.sender_lock:
+                session.retries.append((task, reason))
+        else:
+            stats["failed"] += 1
             logging.exception(
                 "in __batch_callback(), %s",
                 exc_info=exception,
             )
 
-    def do_batch(self):
-        """In main#do_label, we loop over all objects. But for efficienccy, we do not process
-        then all at once, but rather gather objects and process them in batches of
-        self._BATCH_SIZE as we loop; then parse the remaining at the end of the loop"""
+    def __send_batch(self, session: LabelingSession):
+        """Hand the batch of the session over to a sender thread, first waiting while
+        _MAX_OUTSTANDING_BATCHES are outstanding. Called with session.lock held."""
+        if session.batch is not None and session.counter > 0:
+            batch = (session.batch, session.batch_tasks, session.batch_stats)
+            self.__outstanding.acquire()
+            try:
+                future = self.__sender.submit(
+                    self.__execute_batch, session, *batch, session.counter
+                )
+            except Exception:
+                self.__outstanding.release()
+                raise
+            with session.sender_lock:
+                session.sent_batches.add(future)
+            future.add_done_callback(partial(self.__batch_sent, session))
+        self.__new_batch(session)
+
+    def __batch_sent(self, session: LabelingSession, future: Future):
+        with session.sender_lock:
+            session.sent_batches.discard(future)
+        self.__outstanding.release()
+
+    def __execute_batch(self, session, batch, tasks, stats, task_count):
+        start = time.time()
         try:
-            if self._batch is not None:
-                self._batch.execute()
+            # The HTTP object of the Google API Client is not thread-safe
+            batch.execute(http=gcp_utils.thread_local_http())
         except Exception:
             logging.exception("Exception executing _batch()")
+        # Tasks without a callback, when the batch as a whole failed
+        for task in tasks.values():
+            if task[1] <= self._BATCH_MAX_RETRIES:
+                stats["transient"] += 1
+                with session.sender_lock:
+                    session.retries.append((task, "transient"))
+            else:
+                stats["failed"] += 1
+        with session.sender_lock:
+            session.stats.update(stats)
+        self.__adapt_batch_size(session, task_count, time.time() - start, stats)
+
+    def __adapt_batch_size(self, session, task_count, seconds, stats):
+        with self.__batch_size_lock:
+            slow = seconds > self._SLOW_BATCH_SECONDS
+            if stats["transient"] > task_count * 0.05 or slow:
+                self.__batch_size = max(self._MIN_BATCH_SIZE, self.__batch_size // 2)
+            elif task_count >= self.__batch_size:
+                self.__batch_size = min(
+                    self._BATCH_SIZE, self.__batch_size + self._BATCH_SIZE_STEP
+                )
+            batch_size = self.__batch_size
+        logging.info(
+            "Batch of %d for %s in %s in %.1f s: %d ok, %d failed, %d to retry "
+            "(%d transient, %d stale); batch size now %d",
+            task_count,
+            type(self).__name__,
+            session.project_id,
+            seconds,
+            stats["ok"],
+            stats["failed"],
+            stats["transient"] + stats["stale"],
+            stats["transient"],
+            stats["stale"],
+            batch_size,
+        )
+
+    def __retry_task(self, session: LabelingSession, task, reason: str):
+        gcp_object, attempt = task
+        project_id = session.project_id
+        try:
+            if reason == "stale":
+                gcp_object = self._refetch_resource(gcp_object, project_id)
+                if gcp_object is None:
+                    logging.error("Cannot refetch to retry labeling in %s", project_id)
+                    return
+            self.__retrying.attempt = attempt + 1
+            self.label_resource(gcp_object, session)
+        except Exception:
+            logging.exception("Retrying labeling in %s", project_id)
+        finally:
+            self.__retrying.attempt = 1
+
+    def do_batch(self, session: LabelingSession):
+        """In main#do_label, we loop over all objects. But for efficienccy, we do not process
+        then all at once, but rather gather objects and process them in batches
+        as we loop; then parse the remaining at the end of the loop.
+        Full batches are executed on sender threads while the loop goes on. This sends the
+        rest, waits for all sent batches, and retries failed tasks after an exponential backoff.
+        Called when the labeling session ends.
+        If the session has a deadline, this ends _BATCH_DRAIN_SECONDS after it: Batches still
+        running then are left to finish on their sender threads, and tasks not yet retried
+        count as failed, to be labeled in a later run.
+        """
+        drain_deadline = (
+            None
+            if session.deadline is None
+            else session.deadline + self._BATCH_DRAIN_SECONDS
+        )
 
-        self.__init_batch_req()
+        def remaining() -> Optional[float]:
+            if drain_deadline is None:
+                return None
+            return max(0.0, drain_deadline - time.time())
+
+        while True:
+            with session.lock:
+                self.__send_batch(session)
+            with session.sender_lock:
+                sent = list(session.sent_batches)
+            _, not_done = wait(sent, timeout=remaining())
+            if not_done:
+                logging.warning(
+                    "Out of time waiting for %d batches of %s in %s",
+                    len(not_done),
+                    type(self).__name__,
+                    session.project_id,
+                )
+                return
+            with session.sender_lock:
+                retries, session.retries = session.retries, []
+            if not retries:
+                return
+            attempt = max(task[1] for task, _ in retries)
+            backoff = min(2**attempt, 30) * random.uniform(0.5, 1.5)
+            time_left = remaining()
+            if time_left is not None and backoff >= time_left:
+                logging.warning(
+                    "Out of time to retry %d label updates of %s in %s",
+                    len(retries),
+                    type(self).__name__,
+                    session.project_id,
+                )
+                with session.sender_lock:
+                    session.stats["failed"] += len(retries)
+                return
+            time.sleep(backoff)
+            for task, reason in retries:
+                self.__retry_task(session, task, reason)
 
     @abstractmethod
-    def label_all(self, project_id):
-        """Label all objects of a type in a given project"""
+    def label_all(
+        self,
+        project_id,
+        cursor: Optional[Dict] = None,
+        deadline: Optional[float] = None,
+    ) -> Optional[Dict]:
+        """
+        Label all objects of a type in a given project, within a labeling_session.
+        :param cursor: where to resume, as returned by an earlier call that ran out of time.
+        :param deadline: epoch-seconds after which no more pages (or zones) should be started.
+        :return a cursor for resuming, if the deadline passed before all objects were labeled,
+        or None if labeling is complete.
+        """
         pass
 
+    async def label_all_async(
+        self,
+        project_id,
+        cursor: Optional[Dict] = None,
+        deadline: Optional[float] = None,
+    ) -> Optional[Dict]:
+        """
+        label_all as a coroutine, for the asyncio mode (async_labeling in the config).
+        This default runs label_all on a worker thread. Plugins override it
+        to keep many calls in flight on the event loop, limiting each API
+        with util.async_utils.api_semaphore.
+        """
+        return await asyncio.to_thread(self.label_all, project_id, cursor, deadline)
+
+    @staticmethod
+    def _out_of_time(deadline: Optional[float]) -> bool:
+        return deadline is not None and time.time() >= deadline
+
+    def _label_pages(
+        self,
+        session: LabelingSession,
+        pages: Iterable[Tuple[Iterable[Dict], Optional[str]]],
+        deadline: Optional[float],
+    ) -> Optional[Dict]:
+        """
+        Label the resources of each page, as returned by a paged list call.
+        :param pages: for each page, its resources and the token of the following page.
+        Pages should be fetched lazily, so that none are fetched after the deadline.
+        :return a cursor with the token of the next page if the deadline passed, or else None
+        """
+        for resources, next_page_token in pages:
+            for resource in resources:
+                try:
+                    self.label_resource(resource, session)
+                except Exception:
+                    logging.exception("")
+            if next_page_token and self._out_of_time(deadline):
+                return {"page_token": next_page_token}
+        return None
+
     @abstractmethod
     def get_gcp_object(self, log_data: Dict) -> Optional[Dict]:
         """Parse logging data to get a GCP object"""
         pass
 
     @abstractmethod
-    def label_resource(self, gcp_object: Dict, project_id: str):
+    def label_resource(self, gcp_object: Dict, session: LabelingSession):
         """Label a single new object based on its description that comes from alog-line.
         Not clear why we cannot get the project_id out of the gcp_object since the PubSub/Logging
-        messages seem to have this. Maybe one type of resource does not include project_id"""
+        messages seem to have this. Maybe one type of resource does not include project_id,
+        so it is taken from the session."""
         pass
 
-    def _build_labels(self, gcp_object, project_id):
+    def _build_labels(self, gcp_object, session: LabelingSession):
         """
         :return dict including original labels, project labels (if the system is configured to add those)
         and new labels. But if that would result in no change, return None
         """
+        project_id = session.project_id
+        self.__count_resource(session)
         original_labels = gcp_object.get("labels", {})
         project_labels = (
             self._project_labels(project_id) if is_copying_labels_from_project() else {}
@@ -170,6 +674,7 @@ class Plugin(metaclass=ABCMeta):
         all_labels = {**original_labels, **project_labels, **iris_labels}
         if all_labels == original_labels:
             # Skip labeling  because no change
+            self.__mark_correctly_labeled(session, gcp_object)
             return None
         else:
             labels = {"labels": all_labels}
@@ -196,56 +701,139 @@ class Plugin(metaclass=ABCMeta):
             logging.exception("")
             return None
 
-    def __init_batch_req(self):
-        self.counter = 0
+    def __new_batch(self, session: LabelingSession):
+        session.counter = 0
+        session.batch_tasks = {}
+        session.batch_stats = Counter()
         google_api_client = self._google_api_client()
         if google_api_client is None:
-            self._batch = None
+            session.batch = None
         else:
-            self._batch = google_api_client.new_batch_http_request(
-                callback=self.__batch_callback
+            session.batch = google_api_client.new_batch_http_request(
+                callback=partial(
+                    self.__batch_callback,
+                    session,
+                    session.batch_tasks,
+                    session.batch_stats,
+                )
             )
 
 
 class PluginHolder:
-    # Map from class to instance
+    # Map from class to instance, for the plugins that were loaded so far
     plugins: Dict[Type[Plugin], Optional[Plugin]]
     plugins = {}
     __lock = threading.Lock()
 
+    # The modules of the enabled plugins; each is imported when first needed
+    __plugin_modules: Tuple[str, ...] = ()
+    # Reentrant, as plugin_classes loads each class
+    __load_lock = threading.RLock()
+
+    # Map from method name (lowercase), as declared in plugin_methods.py, to the plugin module
+    __method_index: Dict[str, str] = {}
+    # Numbers of dot-separated parts in the method names, longest first
+    __method_part_counts: Tuple[int, ...] = ()
+
     def __init__(self):
         raise NotImplementedError("Do not instantiate")
 
     @classmethod
     def plugin_cls_by_name(cls, name) -> Type[Plugin]:
-        return cls_by_name(PLUGINS_MODULE + "." + name.lower() + "." + name.title())
+        """Imports the plugin module, if not yet imported"""
+        module = name.lower()
+        with cls.__load_lock:
+            plugin_cls = cls_by_name(PLUGINS_MODULE + "." + module + "." + name.title())
+            if plugin_cls not in cls.plugins:
+                assert module in cls.__plugin_modules, f"{name} is not enabled"
+                plugin_cls._label_extractors()  # Precompile, so requests need not
+                cls.plugins[
+                    plugin_cls
+                ] = None  # Initialize with NO instance to avoid importing
+            return plugin_cls
 
     @classmethod
     @log_time
     def init(cls):
-        """Loads the classes, but does not create instances, which happens
-        in get_plugin_instance"""
-
-        def load_plugin_class(name) -> Type:
-            module_name = PLUGINS_MODULE + "." + name
-            __import__(module_name)
-            assert name == name.lower()
-            return cls.plugin_cls_by_name(name)
-
-        loaded = []
-        for _, module, _ in pkgutil.iter_modules([PLUGINS_MODULE]):
-            if config_utils.is_plugin_enabled(module):
-                plugin_class = load_plugin_class(module)
-                cls.plugins[
-                    plugin_class
-                ] = None  # Initialize with NO instance to avoid importing
-                loaded.append(plugin_class.__name__)
+        """Finds the enabled plugins, but neither imports their modules, which happens
+        in plugin_cls_by_name, when a request first needs the plugin, nor creates
+        instances, which happens in get_plugin_instance. This keeps cold start fast
+        and small, as most requests need only one plugin."""
+        cls.__plugin_modules = tuple(
+            module
+            for _, module, _ in pkgutil.iter_modules([PLUGINS_MODULE])
+            if config_utils.is_plugin_enabled(module)
+        )
+        assert all(m == m.lower() for m in cls.__plugin_modules)
+        assert cls.__plugin_modules, "No plugins defined"
+        cls.__build_method_index()
 
-        assert cls.plugins, "No plugins defined"
+    @classmethod
+    def plugin_classes(cls) -> List[Type[Plugin]]:
+        """:return the classes of all enabled plugins, importing their modules if needed"""
+        with cls.__load_lock:
+            return [cls.plugin_cls_by_name(m) for m in cls.__plugin_modules]
+
+    @classmethod
+    def __build_method_index(cls):
+        """
+        Index the method names of the plugins, so that the plugin for a log message is found
+        with a few lookups. Fails on ambiguous method names, i.e., if one is a substring of
+        another's from another plugin, since a log methodName could then match both.
+        The names are those declared in plugin_methods.py, so no plugin module is imported.
+        """
+        index: Dict[str, str] = {}
+        for module in cls.__plugin_modules:
+            assert module in METHOD_NAMES, f"{module} is missing in plugin_methods.py"
+            for method_name in METHOD_NAMES[module]:
+                normalized = method_name.lower()
+                other = index.setdefault(normalized, module)
+                if other != module:
+                    raise Exception(
+                        f"Method {method_name} is in both {other} and {module}"
+                    )
+        for name, module in index.items():
+            for other_name, other_module in index.items():
+                if other_module != module and name in other_name:
+                    raise Exception(
+                        f"Ambiguous methods: {name} of {module} "
+                        f"is in {other_name} of {other_module}"
+                    )
+        cls.__method_index = index
+        cls.__method_part_counts = tuple(
+            sorted({n.count(".") + 1 for n in index}, reverse=True)
+        )
+
+    @classmethod
+    def plugin_cls_for_method(cls, method_from_log: str) -> Optional[Type[Plugin]]:
+        """
+        :param method_from_log: methodName of a log message. It may have a prefix beyond the
+        method name of the plugin, as in "google.pubsub.v1.Subscriber.CreateSubscription"
+        or "beta.compute.instances.insert"; so we look up its dot-separated suffixes.
+        :return the plugin class that handles the method, or None. Only the module of
+        that plugin is imported.
+        """
+        module = cls.__plugin_module_for_method(method_from_log)
+        return None if module is None else cls.plugin_cls_by_name(module)
+
+    @classmethod
+    def __plugin_module_for_method(cls, method_from_log: str) -> Optional[str]:
+        normalized = method_from_log.lower()
+        parts = normalized.split(".")
+        for count in cls.__method_part_counts:
+            if count <= len(parts):
+                module = cls.__method_index.get(".".join(parts[-count:]))
+                if module is not None:
+                    return module
+        # Method names may also match elsewhere than at the end of the methodName
+        for name, module in cls.__method_index.items():
+            if name in normalized:
+                return module
+        return None
 
     @classmethod
     def get_plugin_instance(cls, plugin_cls: Type[Plugin]):
-        """Lazy-initialize  the instance. The classes are loaded in init()"""
+        """Lazy-initialize  the instance. The classes are loaded in plugin_cls_by_name()"""
         with cls.__lock:
             plugin_instance: Plugin = cls.plugins[plugin_cls]
             # Note: We initialized all keys in cls.plugins
@@ -260,6 +848,34 @@ class PluginHolder:
                 cls.plugins[plugin_cls] = plugin_instance
                 return plugin_instance
 
+    @classmethod
+    def warm_up(cls):
+        """
+        Create the instances of the plugins configured in warm_up_plugins, with their
+        Google API Clients, so that the first requests need not. The other plugins are
+        imported when first needed, to keep the memory of the instance small.
+        Logs the time and memory that each takes.
+        """
+        for module in config_utils.warm_up_plugins():
+            if module not in cls.__plugin_modules:
+                continue
+            start = time.time()
+            mem_before = gcp_utils.current_mem_usage_mb()
+            try:
+                plugin_cls = cls.plugin_cls_by_name(module)
+                cls.get_plugin_instance(plugin_cls)
+                plugin_cls._google_api_client()
+            except Exception:
+                logging.exception("Cannot warm up %s", module)
+                continue
+            logging.info(
+                "Warmed up %s in %d ms; RAM %d MB, was %d MB",
+                plugin_cls.__name__,
+                int((time.time() - start) * 1000),
+                gcp_utils.current_mem_usage_mb(),
+                mem_before,
+            )
+
     @classmethod
     def get_plugin_instance_by_name(cls, plugin_class_name: str):
         plugin_cls = cls.plugin_cls_by_name(plugin_class_name)
@@ -0,0 +1,22 @@
+"""
+The methods, in the Google REST APIs, whose logs indicate the creation of the resources
+of each plugin, by plugin module. See Plugin.method_names.
+
+They are kept here, rather than in the plugin modules, so that PluginHolder can index
+them at startup, to dispatch label_one, without importing every plugin module.
+"""
+from typing import Dict, Tuple
+
+METHOD_NAMES: Dict[str, Tuple[str, ...]] = {
+    "bigquery": ("datasetservice.insert", "tableservice.insert"),
+    "buckets": ("storage.buckets.create",),
+    "cloudsql": ("cloudsql.instances.create",),
+    # As of 2021-10-12,   beta.compute.disks.insert
+    "disks": ("compute.disks.insert",),
+    "instances": ("compute.instances.insert", "compute.instances.start"),
+    "snapshots": ("compute.disks.createSnapshot", "compute.snapshots.insert"),
+    # Actually "google.pubsub.v1.Subscriber.CreateSubscription" but  substring is allowed
+    "subscriptions": ("Subscriber.CreateSubscription",),
+    # Actually "google.pubsub.v1.Publisher.CreateTopic", but substring is allowed
+    "topics": ("Publisher.CreateTopic",),
+}
@@ -3,18 +3,33 @@ Labeling BQ tables and datasets.
 """
 
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import lru_cache
+from typing import Dict, Optional
 
 from googleapiclient import errors
-from ratelimit import limits, sleep_and_retry
 
 from plugin import Plugin
-from util.gcp import gcp_utils
 from util.gcp.gcp_utils import add_loaded_lib
+from util.rate_limit import KeyedRateLimiter
 from util.utils import log_time, timing, dict_to_camelcase
 
+# BigQuery's quotas on metadata updates are 5 operations per 10 seconds, per dataset and per table.
+# Dataset updates are sent one by one, so they are limited here, just before sending.
+# Table patches are sent in batches, later and on another thread, so limiting when they are
+# added to the batch would not limit when they are sent. Each table is patched at most once
+# per batch; a patch that exceeds the quota fails with 403 rateLimitExceeded, and do_batch
+# retries it with backoff.
+_dataset_update_limiter = KeyedRateLimiter(calls=5, period=10)
+
+# Returned for a dataset that was not started because the deadline had passed
+_NOT_STARTED = "not-started"
+
 
 class Bigquery(Plugin):
+    __DATASET_WORKERS = 8
+    __PAGE_SIZE = 100
+
     @staticmethod
     def _discovery_api():
         return "bigquery", "v2"
@@ -33,8 +48,8 @@ class Bigquery(Plugin):
         return bigquery.Client(project=project_id)
 
     @staticmethod
-    def method_names():
-        return ["datasetservice.insert", "tableservice.insert"]
+    def _label_state_key_field():
+        return "id"
 
     def _gcp_name(self, gcp_object):
         """Method dynamically called in generating labels, so don't change name"""
@@ -118,33 +133,108 @@ class Bigquery(Plugin):
             logging.exception("")
             return None
 
-    def label_all(self, project_id):
+    def label_all(self, project_id, cursor=None, deadline=None):
         """
-        Label both tables and data sets
+        Label both tables and data sets. Datasets are processed concurrently, a page of
+        datasets at a time, and each dataset's tables are streamed page by page into the batch.
+        The cursor is the token of the page of datasets to resume from. If the deadline
+        passed within that page, it also has the datasets of the page that were done, and
+        the token of the next page of tables for each dataset that was started but not done.
+        Datasets not yet started when the deadline passed are neither, and are started
+        on resumption.
         """
-        with timing(f"label_all for BigQuery in {project_id}"):
-            datasets = self._cloudclient(project_id).list_datasets()
-            for dataset in datasets:
-                self.__label_dataset_and_tables(project_id, dataset._properties)
-
-            if self.counter > 0:
-                self.do_batch()  # Used for Tables, not Datasets
+        cursor = cursor or {}
+        page_token = cursor.get("page_token")
+        datasets_done = set(cursor.get("datasets_done", []))
+        table_page_tokens: Dict[str, str] = dict(cursor.get("table_page_tokens", {}))
+        next_cursor = None
+        with timing(
+            f"label_all for BigQuery in {project_id}"
+        ), self.labeling_session(project_id, deadline=deadline) as session:
+            datasets = self._cloudclient(project_id).list_datasets(
+                page_size=self.__PAGE_SIZE, page_token=page_token
+            )
+            with ThreadPoolExecutor(max_workers=self.__DATASET_WORKERS) as executor:
+                for page in datasets.pages:
+                    not_started = False
+                    futs = {
+                        executor.submit(
+                            self.__label_dataset_and_tables,
+                            session,
+                            dataset._properties,
+                            table_page_tokens.get(dataset.dataset_id),
+                            deadline,
+                        ): dataset.dataset_id
+                        for dataset in page
+                        if dataset.dataset_id not in datasets_done
+                    }
+                    for future in as_completed(futs):
+                        dataset_id = futs[future]
+                        try:
+                            tables_token = future.result()
+                        except Exception:
+                            logging.exception("Error labeling dataset")
+                            tables_token = None
+                        if tables_token == _NOT_STARTED:
+                            # Neither done nor with a table page token; resumed from the start
+                            not_started = True
+                        elif tables_token:
+                            table_page_tokens[dataset_id] = tables_token
+                        else:
+                            table_page_tokens.pop(dataset_id, None)
+                            datasets_done.add(dataset_id)
+                    if table_page_tokens or not_started:
+                        next_cursor = {
+                            "page_token": page_token,
+                            "datasets_done": sorted(datasets_done),
+                            "table_page_tokens": table_page_tokens,
+                        }
+                        break
+                    page_token = datasets.next_page_token
+                    datasets_done = set()
+                    if page_token and self._out_of_time(deadline):
+                        next_cursor = {"page_token": page_token}
+                        break
+        # The batch of the session is used for Tables, not Datasets
+        return next_cursor
 
-    def __label_dataset_and_tables(self, project_id, dataset):
-        self.__label_one_dataset(dataset, project_id)
-        self.__label_tables_for_dataset(dataset, project_id)
+    def __label_dataset_and_tables(
+        self, session, dataset, tables_token, deadline
+    ) -> Optional[str]:
+        """
+        :return the token of the next page of tables, if the deadline passed, or _NOT_STARTED
+        if it passed before this dataset was started
+        """
+        if self._out_of_time(deadline):
+            return tables_token or _NOT_STARTED
+        # When resuming the tables of a dataset, the dataset itself was already labeled
+        if tables_token is None and not self._unchanged_since_last_run(
+            session, dataset
+        ):
+            self.__label_one_dataset(dataset, session)
+        return self.__label_tables_for_dataset(dataset, session, tables_token, deadline)
 
-    def __label_tables_for_dataset(self, dataset, project_id):
+    def __label_tables_for_dataset(
+        self, dataset, session, page_token, deadline
+    ) -> Optional[str]:
+        project_id = session.project_id
         ds_id = dataset["id"].replace(":", ".")
-        for table in self._cloudclient(project_id).list_tables(dataset=ds_id):
-            table_dict = table._properties
-            table_dict["location"] = dataset["location"]
-            self.__label_one_table(table_dict, project_id)
-
-    @sleep_and_retry
-    @limits(calls=35, period=60)
-    def __label_one_dataset(self, gcp_object, project_id):
-        labels = self._build_labels(gcp_object, project_id)
+        tables = self._cloudclient(project_id).list_tables(
+            dataset=ds_id, page_size=self.__PAGE_SIZE, page_token=page_token
+        )
+        for page in tables.pages:
+            for table in page:
+                table_dict = table._properties
+                table_dict["location"] = dataset["location"]
+                if not self._unchanged_since_last_run(session, table_dict):
+                    self.__label_one_table(table_dict, session)
+            if tables.next_page_token and self._out_of_time(deadline):
+                return tables.next_page_token
+        return None
+
+    def __label_one_dataset(self, gcp_object, session):
+        project_id = session.project_id
+        labels = self._build_labels(gcp_object, session)
         if labels is None:
             return
         try:
@@ -154,20 +244,26 @@ class Bigquery(Plugin):
             assert (
                 project_id == dataset_reference["projectId"]
             ), f"{project_id}!={dataset_reference['projectId']}"
+            # Local import to avoid burdening AppEngine memory.
+            # Loading all Cloud Client libraries would be 100MB  means that
+            # the default AppEngine Instance crashes on out-of-memory even before actually serving a request.
+            from google.cloud import bigquery
 
-            client = self._cloudclient(project_id)
-            ds = client.get_dataset(f"{project_id}.{dataset_id}")
+            # Update the dataset as already listed or fetched, rather than fetching it again.
+            # If it has an etag, the update is conditional on it. Only datasets fetched in
+            # label_one have one: datasets.list returns no etag, so updates in label_all
+            # are unconditional.
+            ds = bigquery.Dataset.from_api_repr(gcp_object)
             ds.labels = labels["labels"]
-            client.update_dataset(ds, ["labels"])
+            _dataset_update_limiter.acquire(f"{project_id}.{dataset_id}")
+            self._cloudclient(project_id).update_dataset(ds, ["labels"])
         except Exception:
             logging.exception("")
 
-    @sleep_and_retry
-    @limits(calls=35, period=60)
-    def __label_one_table(self, gcp_object, project_id):
+    def __label_one_table(self, gcp_object, session):
         """
         This often produces the following error. Hard to avoid, given that we are using batch operations. But
-        that is why we sleep_and_retry, above.
+        that is why do_batch retries rate-limit errors with backoff.
 
         Error in Request Id: None Response: 72edf87e-d6fe-46b5-831a-e7b7bcd51cb0
         Exception: <HttpError 403 when requesting
@@ -175,34 +271,35 @@ class Bigquery(Plugin):
         returned "Exceeded rate limits: too many table update operations for this table.
         For more information, see https://cloud.google.com/bigquery/troubleshooting-errors".
         """
-        labels = self._build_labels(gcp_object, project_id)
+        labels = self._build_labels(gcp_object, session)
         if labels is None:
             return
         try:
             table_reference = gcp_object["tableReference"]
-            self._batch.add(
-                self._google_api_client()
-                .tables()
-                .patch(
-                    projectId=table_reference["projectId"],
-                    body=labels,
-                    datasetId=table_reference["datasetId"],
-                    tableId=table_reference["tableId"],
-                ),
-                request_id=gcp_utils.generate_uuid(),
-            )
-            self.counter += 1
-            if self.counter >= self._BATCH_SIZE:
-                self.do_batch()
+            self.__add_table_patch(session, table_reference, labels, gcp_object)
         except Exception:
             logging.exception("")
 
+    def __add_table_patch(self, session, table_reference, labels, gcp_object):
+        self._add_to_batch(
+            session,
+            self._google_api_client()
+            .tables()
+            .patch(
+                projectId=table_reference["projectId"],
+                body=labels,
+                datasetId=table_reference["datasetId"],
+                tableId=table_reference["tableId"],
+            ),
+            gcp_object,
+        )
+
     @log_time
-    def label_resource(self, gcp_object, project_id):
+    def label_resource(self, gcp_object, session):
         try:
             if gcp_object["kind"] == "bigquery#dataset":
-                self.__label_one_dataset(gcp_object, project_id)
+                self.__label_one_dataset(gcp_object, session)
             else:
-                self.__label_one_table(gcp_object, project_id)
+                self.__label_one_table(gcp_object, session)
         except Exception:
             logging.exception("")
@@ -2,7 +2,6 @@ import logging
 from functools import lru_cache
 
 from plugin import Plugin
-from util.gcp import gcp_utils
 from util.gcp.gcp_utils import add_loaded_lib
 from util.utils import log_time, timing, dict_to_camelcase
 
@@ -12,10 +11,6 @@ class Buckets(Plugin):
     def _discovery_api():
         return "storage", "v1"
 
-    @staticmethod
-    def method_names():
-        return ["storage.buckets.create"]
-
     @classmethod
     @lru_cache(maxsize=500)  # cached per project
     def _cloudclient(cls, project_id=None):
@@ -28,6 +23,14 @@ class Buckets(Plugin):
         add_loaded_lib("storage")
         return storage.Client(project=project_id)
 
+    @staticmethod
+    def _resource_fields():
+        return "name", "location", "labels"
+
+    @staticmethod
+    def _label_state_version_fields():
+        return "etag", "labels"
+
     def _gcp_name(self, gcp_object):
         """Method dynamically called in generating labels, so don't change name"""
         return self._name_no_separator(gcp_object)
@@ -54,6 +57,9 @@ class Buckets(Plugin):
             logging.exception("")
             return None
 
+    def _refetch_resource(self, gcp_object, project_id):
+        return self._get_resource(gcp_object["name"], project_id)
+
     def get_gcp_object(self, log_data):
         # bucket_name is the built-in bucket name, not the label
         buck_name = log_data["resource"]["labels"]["bucket_name"]
@@ -73,39 +79,45 @@ class Buckets(Plugin):
         d3 = dict_to_camelcase(d2)
         return d3
 
-    def _list_all(self, project_id):
-        buckets = self._cloudclient(project_id).list_buckets()
-        return (
-            self.__response_obj_to_dict(bucket_response) for bucket_response in buckets
+    def _list_all(self, session, page_token=None):
+        """:return for each page, its buckets and the token of the next page"""
+        # The JSON API cannot filter buckets by label
+        buckets = self._cloudclient(session.project_id).list_buckets(
+            page_token=page_token, fields=self._list_fields_mask()
         )
-
-    def label_all(self, project_id):
-        with timing(f"label_all(Bucket) in {project_id}"):
-            for o in self._list_all(project_id):
-                try:
-                    self.label_resource(o, project_id)
-                except Exception:
-                    logging.exception("")
-            if self.counter > 0:
-                self.do_batch()
+        for page in buckets.pages:
+            changed = [
+                self.__response_obj_to_dict(bucket_response)
+                for bucket_response in page
+                if not self._unchanged_since_last_run(
+                    session, bucket_response._properties
+                )
+            ]
+            yield changed, buckets.next_page_token
+
+    def label_all(self, project_id, cursor=None, deadline=None):
+        with timing(f"label_all(Bucket) in {project_id}"), self.labeling_session(
+            project_id, deadline=deadline
+        ) as session:
+            pages = self._list_all(session, (cursor or {}).get("page_token"))
+            next_cursor = self._label_pages(session, pages, deadline)
+        return next_cursor
 
     @log_time
-    def label_resource(self, gcp_object, project_id):
-        labels = self._build_labels(gcp_object, project_id)
+    def label_resource(self, gcp_object, session):
+        labels = self._build_labels(gcp_object, session)
         if labels is None:
             return
 
         try:
             bucket_name = gcp_object["name"]
 
-            self._batch.add(
+            self._add_to_batch(
+                session,
                 self._google_api_client()
                 .buckets()
                 .patch(bucket=bucket_name, body=labels),
-                request_id=gcp_utils.generate_uuid(),
+                gcp_object,
             )
-            self.counter += 1
-            if self.counter >= self._BATCH_SIZE:
-                self.do_batch()
         except Exception:
             logging.exception("")
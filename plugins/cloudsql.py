@@ -1,9 +1,12 @@
+import asyncio
 import logging
 from typing import Dict, Optional
 
 from googleapiclient import errors
 
 from plugin import Plugin
+from util.async_utils import api_semaphore
+from util.gcp.gcp_utils import thread_local_http
 from util.utils import log_time, timing
 
 
@@ -12,10 +15,6 @@ class Cloudsql(Plugin):
     def _discovery_api():
         return "sqladmin", "v1beta4"
 
-    @staticmethod
-    def method_names():
-        return ["cloudsql.instances.create"]
-
     @classmethod
     def _cloudclient(cls, _=None):
         raise NotImplementedError(
@@ -24,6 +23,10 @@ class Cloudsql(Plugin):
 
     @staticmethod
     def is_labeled_on_creation() -> bool:
+        return True
+
+    @staticmethod
+    def label_on_creation_deferred() -> bool:
         """
         Labels cannot be applied to CloudSQL during its long initialization phase.
 
@@ -31,8 +34,29 @@ class Cloudsql(Plugin):
             During initialization of CloudSQL Instance, 3 log messages arrive (within 5 sec of each other)
             At the first two, the CloudSQL Instance does not exist, and at the third, it is still PENDING.
         How:
-            As an alternative, maybe use Cloud Tasks instead of Pubsub to allow delay.
+            label_one defers the log message, which is rechecked until the instance is RUNNABLE.
         """
+        return True
+
+    def is_ready_to_label(self, gcp_object: Dict) -> bool:
+        return gcp_object.get("state") == "RUNNABLE"
+
+    @staticmethod
+    def _resource_fields():
+        return "name", "region", "state", "settings"
+
+    @staticmethod
+    def _label_state_version_fields():
+        # The etag changes with the settings, which hold the labels
+        return ("etag",)
+
+    @staticmethod
+    def _unlabeled_filter(label_key):
+        return f"NOT settings.userLabels.{label_key}:*"
+
+    @staticmethod
+    def _labels_projects_concurrently() -> bool:
+        # Calls go through the shared Google API Client, whose HTTP object is not thread-safe
         return False
 
     def _gcp_name(self, gcp_object):
@@ -62,8 +86,8 @@ class Cloudsql(Plugin):
 
     def get_gcp_object(self, log_data: Dict) -> Optional[Dict]:
         try:
-            if "response" not in log_data["protoPayload"]:
-                return None
+            # Any of the log messages of the creation will do, as they are deferred,
+            # and the instance only exists (and is ready) later.
             labels_ = log_data["resource"]["labels"]
             database_id = labels_["database_id"]
             instance = database_id[database_id.rfind(":") + 1 :]
@@ -73,55 +97,119 @@ class Cloudsql(Plugin):
             logging.exception("")
             return None
 
-    def label_all(self, project_id):
-        with timing(f"label_all({type(self).__name__}) in {project_id}"):
-            page_token = None
+    def label_all(self, project_id, cursor=None, deadline=None):
+        with timing(
+            f"label_all({type(self).__name__}) in {project_id}"
+        ), self.labeling_session(project_id, deadline=deadline) as session:
+            page_token = (cursor or {}).get("page_token")
             while True:
-                response = (
-                    self._google_api_client()
-                    .instances()
-                    .list(
-                        project=project_id,
-                        pageToken=page_token,
-                        # Filter supported, but syntax not OK. We get this message: "Field not found. In
-                        # expression labels.iris_name HAS *, At field labels ."
-                    )
-                    .execute()
-                )
+                response = self.__list_page(project_id, page_token)
 
                 if "items" not in response:
-                    return
+                    return None
                 for database_instance in response["items"]:
+                    if self._unchanged_since_last_run(session, database_instance):
+                        continue
                     try:
-                        self.label_resource(database_instance, project_id)
+                        self.label_resource(database_instance, session)
                     except Exception:
                         logging.exception("")
                 if "nextPageToken" in response:
                     page_token = response["nextPageToken"]
+                    if self._out_of_time(deadline):
+                        return {"page_token": page_token}
                 else:
-                    return
+                    return None
 
-    @log_time
-    def label_resource(self, gcp_object, project_id):
-        labels = self._build_labels(gcp_object, project_id)
-        if labels is None:
-            return
+    def __list_page(self, project_id, page_token, http=None) -> Dict:
+        return (
+            self._google_api_client()
+            .instances()
+            .list(
+                project=project_id,
+                pageToken=page_token,
+                # Labels are under settings.userLabels, not labels
+                filter=self._list_filter(),
+                fields=self._list_fields_mask(),
+            )
+            .execute(http=http)
+        )
+
+    async def label_all_async(self, project_id, cursor=None, deadline=None):
+        """
+        There is no async client for this API, so calls run on worker threads, each with
+        its own HTTP object, while many patches are in flight at once.
+        """
+        with timing(
+            f"label_all_async({type(self).__name__}) in {project_id}"
+        ), self.labeling_session(project_id, deadline=deadline) as session:
+            page_token = (cursor or {}).get("page_token")
+            while True:
+                async with api_semaphore("sqladmin"):
+                    response = await asyncio.to_thread(
+                        lambda: self.__list_page(
+                            project_id, page_token, thread_local_http()
+                        )
+                    )
+                await asyncio.gather(
+                    *(
+                        self.__label_resource_async(database_instance, session)
+                        for database_instance in response.get("items", [])
+                        if not self._unchanged_since_last_run(
+                            session, database_instance
+                        )
+                    )
+                )
+                page_token = response.get("nextPageToken")
+                if not page_token:
+                    return None
+                if self._out_of_time(deadline):
+                    return {"page_token": page_token}
+
+    async def __label_resource_async(self, gcp_object, session):
         try:
-            database_instance_body = {"settings": {"userLabels": labels["labels"]}}
+            request = self.__patch_request(gcp_object, session)
+            if request is None:
+                return
+            async with api_semaphore("sqladmin"):
+                await asyncio.to_thread(
+                    lambda: self.__execute_patch(
+                        request, gcp_object, thread_local_http()
+                    )
+                )
+        except Exception:
+            logging.exception("")
 
-            self._google_api_client().instances().patch(
-                project=project_id,
-                body=database_instance_body,
-                instance=gcp_object["name"],
-            ).execute()
+    def __patch_request(self, gcp_object, session):
+        """:return the request to patch labels, or None if they are already correct"""
+        labels = self._build_labels(gcp_object, session)
+        if labels is None:
+            return None
+        database_instance_body = {"settings": {"userLabels": labels["labels"]}}
+        return self._google_api_client().instances().patch(
+            project=session.project_id,
+            body=database_instance_body,
+            instance=gcp_object["name"],
+        )
 
+    @log_time
+    def label_resource(self, gcp_object, session):
+        request = self.__patch_request(gcp_object, session)
+        if request is None:
+            return
+        self.__execute_patch(request, gcp_object)
+
+    @staticmethod
+    def __execute_patch(request, gcp_object, http=None):
+        try:
+            request.execute(http=http)
         except errors.HttpError as e:
             if "PENDING_CREATE" == gcp_object.get("state"):
                 logging.exception(
-                    "CloudSQL cannot accept labels until it is fully initialized, and that occurs long after"
-                    "Iris receives the notification. This is why"
+                    "CloudSQL cannot accept labels until it is fully initialized, and that occurs long after "
+                    "Iris receives the notification. This is why "
                     "we do not label it on-creation in the usual way, but "
-                    "rather in a scheduled job.",
+                    "rather through the deferred queue.",
                 )
 
             raise e
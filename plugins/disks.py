@@ -6,7 +6,6 @@ from functools import lru_cache
 from googleapiclient import errors
 
 from gce_base.gce_zonal_base import GceZonalBase
-from util.gcp import gcp_utils
 from util.gcp.gcp_utils import add_loaded_lib
 from util.utils import log_time
 
@@ -35,11 +34,6 @@ class Disks(GceZonalBase):
         with cls.__lock:
             return cls._create_cloudclient()
 
-    @staticmethod
-    def method_names():
-        # As of 2021-10-12,   beta.compute.disks.insert
-        return ["compute.disks.insert"]
-
     @staticmethod
     def relabel_on_cron() -> bool:
         """
@@ -49,15 +43,41 @@ class Disks(GceZonalBase):
         """
         return True
 
-    def _list_all(self, project_id, zone) -> typing.List[typing.Dict]:
+    @staticmethod
+    def _resource_fields():
+        return *GceZonalBase._resource_fields(), "users"
+
+    @staticmethod
+    def _label_state_version_fields():
+        # Attachment, as labeled by _gcp_pd_attached, does not change the label fingerprint
+        return "labelFingerprint", "users"
+
+    def _list_all(self, session, zone) -> typing.List[typing.Dict]:
+        # Local import to avoid burdening AppEngine memory.
+        # Loading all Cloud Client libraries would be 100MB  means that
+        # the default AppEngine Instance crashes on out-of-memory even before actually serving a request.
+        from google.cloud import compute_v1
+
+        add_loaded_lib("compute_v1")
+        request = compute_v1.ListDisksRequest(
+            project=session.project_id, zone=zone, filter=self._list_filter()
+        )
+        return self._list_resources_as_dicts(request, session)
+
+    def _aggregated_list_all(self, session, page_token=None):
         # Local import to avoid burdening AppEngine memory.
         # Loading all Cloud Client libraries would be 100MB  means that
         # the default AppEngine Instance crashes on out-of-memory even before actually serving a request.
         from google.cloud import compute_v1
 
         add_loaded_lib("compute_v1")
-        request = compute_v1.ListDisksRequest(project=project_id, zone=zone)
-        return self._list_resources_as_dicts(request)
+        request = compute_v1.AggregatedListDisksRequest(
+            project=session.project_id,
+            page_token=page_token,
+            filter=self._list_filter(),
+            return_partial_success=True,
+        )
+        return self._aggregated_list_pages_as_dicts(request, session, "disks")
 
     def _get_resource(self, project_id, zone, name):
         try:
@@ -77,28 +97,26 @@ class Disks(GceZonalBase):
             return None
 
     @log_time
-    def label_resource(self, gcp_object, project_id):
-        with self._write_lock:
-            labels = self._build_labels(gcp_object, project_id)
-            if labels is None:
-                return
-
-            zone = self._gcp_zone(gcp_object)
-
-            self._batch.add(
-                self._google_api_client()
-                .disks()
-                .setLabels(
-                    project=project_id,
-                    zone=zone,
-                    resource=gcp_object["name"],
-                    body=labels,
-                ),
-                request_id=gcp_utils.generate_uuid(),
-            )
-            self.counter += 1
-            if self.counter >= self._BATCH_SIZE:
-                self.do_batch()
+    def label_resource(self, gcp_object, session):
+        project_id = session.project_id
+        labels = self._build_labels(gcp_object, session)
+        if labels is None:
+            return
+
+        zone = self._gcp_zone(gcp_object)
+
+        self._add_to_batch(
+            session,
+            self._google_api_client()
+            .disks()
+            .setLabels(
+                project=project_id,
+                zone=zone,
+                resource=gcp_object["name"],
+                body=labels,
+            ),
+            gcp_object,
+        )
 
     def _gcp_pd_attached(self, gcp_object):
         """Method dynamically called in generating labels, so don't change name"""
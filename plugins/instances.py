@@ -6,7 +6,6 @@ from typing import Dict, Optional, List
 from googleapiclient import errors
 
 from gce_base.gce_zonal_base import GceZonalBase
-from util.gcp import gcp_utils
 from util.gcp.gcp_utils import add_loaded_lib
 from util.utils import log_time
 
@@ -31,8 +30,13 @@ class Instances(GceZonalBase):
             return cls._create_cloudclient()
 
     @staticmethod
-    def method_names():
-        return ["compute.instances.insert", "compute.instances.start"]
+    def _label_state_version_fields():
+        # Machine type can change when the instance is stopped
+        return "labelFingerprint", "machineType"
+
+    @staticmethod
+    def _resource_fields():
+        return *GceZonalBase._resource_fields(), "machineType"
 
     def _gcp_instance_type(self, gcp_object: dict):
         """Method dynamically called in generating labels, so don't change name"""
@@ -45,15 +49,32 @@ class Instances(GceZonalBase):
             logging.exception("")
             return None
 
-    def _list_all(self, project_id, zone) -> List[Dict]:
+    def _list_all(self, session, zone) -> List[Dict]:
+        # Local import to avoid burdening AppEngine memory.
+        # Loading all Cloud Client libraries would be 100MB  means that
+        # the default AppEngine Instance crashes on out-of-memory even before actually serving a request.
+        from google.cloud import compute_v1
+
+        add_loaded_lib("compute_v1")
+        page_result = compute_v1.ListInstancesRequest(
+            project=session.project_id, zone=zone, filter=self._list_filter()
+        )
+        return self._list_resources_as_dicts(page_result, session)
+
+    def _aggregated_list_all(self, session, page_token=None):
         # Local import to avoid burdening AppEngine memory.
         # Loading all Cloud Client libraries would be 100MB  means that
         # the default AppEngine Instance crashes on out-of-memory even before actually serving a request.
         from google.cloud import compute_v1
 
         add_loaded_lib("compute_v1")
-        page_result = compute_v1.ListInstancesRequest(project=project_id, zone=zone)
-        return self._list_resources_as_dicts(page_result)
+        request = compute_v1.AggregatedListInstancesRequest(
+            project=session.project_id,
+            page_token=page_token,
+            filter=self._list_filter(),
+            return_partial_success=True,
+        )
+        return self._aggregated_list_pages_as_dicts(request, session, "instances")
 
     def _get_resource(self, project_id, zone, name) -> Optional[Dict]:
         try:
@@ -73,27 +94,25 @@ class Instances(GceZonalBase):
             return None
 
     @log_time
-    def label_resource(self, gcp_object, project_id):
-        with self._write_lock:
-            labels = self._build_labels(gcp_object, project_id)
-            if labels is None:
-                return
-
-            zone = self._gcp_zone(gcp_object)
-
-            self._batch.add(
-                self._google_api_client()
-                .instances()
-                .setLabels(
-                    project=project_id,
-                    zone=zone,
-                    instance=gcp_object["name"],
-                    body=labels,
-                ),
-                request_id=gcp_utils.generate_uuid(),
-            )
-            # Could use the Cloud Client as follows , but that apparently that does not support batching
-            #  compute_v1.SetLabelsInstanceRequest(project=project_id, zone=zone, instance=name, labels=labels)
-            self.counter += 1
-            if self.counter >= self._BATCH_SIZE:
-                self.do_batch()
+    def label_resource(self, gcp_object, session):
+        project_id = session.project_id
+        labels = self._build_labels(gcp_object, session)
+        if labels is None:
+            return
+
+        zone = self._gcp_zone(gcp_object)
+
+        self._add_to_batch(
+            session,
+            self._google_api_client()
+            .instances()
+            .setLabels(
+                project=project_id,
+                zone=zone,
+                instance=gcp_object["name"],
+                body=labels,
+            ),
+            gcp_object,
+        )
+        # Could use the Cloud Client as follows , but that apparently that does not support batching
+        #  compute_v1.SetLabelsInstanceRequest(project=project_id, zone=zone, instance=name, labels=labels)
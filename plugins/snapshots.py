@@ -4,7 +4,6 @@ from functools import lru_cache
 from googleapiclient import errors
 
 from gce_base.gce_base import GceBase
-from util.gcp import gcp_utils
 from util.gcp.gcp_utils import add_loaded_lib
 from util.utils import log_time, timing
 
@@ -21,19 +20,19 @@ class Snapshots(GceBase):
         add_loaded_lib("compute_v1")
         return compute_v1.SnapshotsClient()
 
-    @staticmethod
-    def method_names():
-        return ["compute.disks.createSnapshot", "compute.snapshots.insert"]
-
-    def _list_all(self, project_id):
+    def _list_all(self, session, page_token=None):
         # Local import to avoid burdening AppEngine memory. Loading all
         # Client libraries would be 100MB  means that the default AppEngine
         # Instance crashes on out-of-memory even before actually serving a request.
         from google.cloud import compute_v1
 
         add_loaded_lib("compute_v1")
-        all_resources = compute_v1.ListSnapshotsRequest(project=project_id)
-        return self._list_resources_as_dicts(all_resources)
+        all_resources = compute_v1.ListSnapshotsRequest(
+            project=session.project_id,
+            page_token=page_token,
+            filter=self._list_filter(),
+        )
+        return self._list_pages_as_dicts(all_resources, session)
 
     def _get_resource(self, project_id, name):
         try:
@@ -49,15 +48,16 @@ class Snapshots(GceBase):
             logging.exception("")
             return None
 
-    def label_all(self, project_id):
-        with timing(f"label_all in {project_id}"):
-            for o in self._list_all(project_id):
-                try:
-                    self.label_resource(o, project_id)
-                except Exception:
-                    logging.exception("")
-            if self.counter > 0:
-                self.do_batch()
+    def _refetch_resource(self, gcp_object, project_id):
+        return self._get_resource(project_id, gcp_object["name"])
+
+    def label_all(self, project_id, cursor=None, deadline=None):
+        with timing(f"label_all in {project_id}"), self.labeling_session(
+            project_id, deadline=deadline
+        ) as session:
+            pages = self._list_all(session, (cursor or {}).get("page_token"))
+            next_cursor = self._label_pages(session, pages, deadline)
+        return next_cursor
 
     def get_gcp_object(self, log_data):
         try:
@@ -73,15 +73,14 @@ class Snapshots(GceBase):
             return None
 
     @log_time
-    def label_resource(self, gcp_object, project_id):
-        labels = self._build_labels(gcp_object, project_id)
+    def label_resource(self, gcp_object, session):
+        project_id = session.project_id
+        labels = self._build_labels(gcp_object, session)
 
-        self._batch.add(  # Using Google Client API because CloudClient has, I think, no batch functionality
+        self._add_to_batch(  # Using Google Client API because CloudClient has, I think, no batch functionality
+            session,
             self._google_api_client()
             .snapshots()
             .setLabels(project=project_id, resource=gcp_object["name"], body=labels),
-            request_id=gcp_utils.generate_uuid(),
+            gcp_object,
         )
-        self.counter += 1
-        if self.counter >= self._BATCH_SIZE:
-            self.do_batch()
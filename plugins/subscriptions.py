@@ -1,6 +1,7 @@
+import asyncio
 import logging
 from functools import lru_cache
-from typing import List, Dict
+from typing import Dict, Optional
 
 from googleapiclient import errors
 
@@ -10,6 +11,8 @@ from util.gcp.gcp_utils import (
     cloudclient_pb_objects_to_list_of_dicts,
     add_loaded_lib,
 )
+from util.async_utils import api_semaphore
+from util.concurrent_writer import ConcurrentWriter
 from util.utils import log_time, timing
 
 
@@ -31,44 +34,118 @@ class Subscriptions(Plugin):
         return None
 
     @staticmethod
-    def method_names():
-        # Actually "google.pubsub.v1.Subscriber.CreateSubscription" but  substring is allowed
-        return ["Subscriber.CreateSubscription"]
-
-    def label_all(self, project_id):
-        with timing(f"label_all({type(self).__name__})  in {project_id}"):
-            for o in self._list_all(project_id):
-                try:
-                    self.label_resource(o, project_id)
-                except Exception:
-                    logging.exception("")
+    def _resource_fields():
+        return "name", "labels", "topic"
+
+    @staticmethod
+    def _label_state_key_field():
+        return "name"
+
+    def label_all(self, project_id, cursor=None, deadline=None):
+        """There is no batch API, so updates run concurrently, with retries"""
+        with timing(
+            f"label_all({type(self).__name__})  in {project_id}"
+        ), self.labeling_session(
+            project_id, deadline=deadline
+        ) as session, ConcurrentWriter(
+            f"{type(self).__name__} in {project_id}"
+        ) as writer:
+            pages = self._list_all(session, (cursor or {}).get("page_token"))
+            for subscriptions, next_page_token in pages:
+                for subscription in subscriptions:
+                    try:
+                        request = self.__update_request(subscription, session)
+                        if request is not None:
+                            writer.submit(self.__update, request)
+                    except Exception:
+                        logging.exception("")
+                if next_page_token and self._out_of_time(deadline):
+                    return {"page_token": next_page_token}
+            return None
 
     def __get_resource(self, path):
         try:
             o = self._cloudclient().get_subscription(subscription=path)
-            return cloudclient_pb_obj_to_dict(o)
+            return cloudclient_pb_obj_to_dict(o, self._projected_fields())
         except errors.HttpError:
             logging.exception("")
             return None
 
-    def _list_all(self, project_id) -> List[Dict]:
-        all_resources = self._cloudclient().list_subscriptions(
-            request={"project": f"projects/{project_id}"}
-        )
-        return cloudclient_pb_objects_to_list_of_dicts(all_resources)
+    def _list_all(self, session, page_token=None):
+        """:return for each page, its subscriptions and the token of the next page"""
+        request = {"project": f"projects/{session.project_id}"}
+        if page_token:
+            request["page_token"] = page_token
+        for page in self._cloudclient().list_subscriptions(request=request).pages:
+            changed = (
+                o
+                for o in page.subscriptions
+                if not self._unchanged_since_last_run(session, o)
+            )
+            yield cloudclient_pb_objects_to_list_of_dicts(
+                changed, self._projected_fields()
+            ), page.next_page_token
 
-    @log_time
-    def label_resource(self, gcp_object: Dict, project_id):
+    async def label_all_async(self, project_id, cursor=None, deadline=None):
+        # Local import to avoid burdening AppEngine memory.
+        # Loading all Cloud Client libraries would be 100MB  means that
+        # the default AppEngine Instance crashes on out-of-memory even before actually serving a request.
+        from google.pubsub_v1.services.subscriber import SubscriberAsyncClient
+
+        add_loaded_lib("pubsub_v1")
+        # Created per call, since its channel belongs to the running event loop
+        client = SubscriberAsyncClient()
+        try:
+            with timing(
+                f"label_all_async({type(self).__name__})  in {project_id}"
+            ), self.labeling_session(project_id, deadline=deadline) as session:
+                request = {"project": f"projects/{project_id}"}
+                if cursor and cursor.get("page_token"):
+                    request["page_token"] = cursor["page_token"]
+                pager = await client.list_subscriptions(request=request)
+                async for page in pager.pages:
+                    changed = (
+                        o
+                        for o in page.subscriptions
+                        if not self._unchanged_since_last_run(session, o)
+                    )
+                    await asyncio.gather(
+                        *(
+                            self.__label_resource_async(client, sub, session)
+                            for sub in cloudclient_pb_objects_to_list_of_dicts(
+                                changed, self._projected_fields()
+                            )
+                        )
+                    )
+                    if page.next_page_token and self._out_of_time(deadline):
+                        return {"page_token": page.next_page_token}
+                return None
+        finally:
+            await client.transport.close()
+
+    async def __label_resource_async(self, client, gcp_object: Dict, session):
+        try:
+            request = self.__update_request(gcp_object, session)
+            if request is None:
+                return
+            async with api_semaphore("pubsub"):
+                await client.update_subscription(request=request)
+            logging.info(f"Updated: {request['subscription'].name}")
+        except Exception:
+            logging.exception("")
+
+    def __update_request(self, gcp_object: Dict, session) -> Optional[Dict]:
+        """:return the request to update labels, or None if they are already correct"""
         # This API does not accept label-fingerprint, so extracting just labels
-        labels_outer = self._build_labels(gcp_object, project_id)
+        labels_outer = self._build_labels(gcp_object, session)
         if labels_outer is None:
-            return
+            return None
         labels = labels_outer["labels"]
 
         name = self._gcp_name(gcp_object)
         parent_topic = gcp_object["topic"].split("/")[-1]
 
-        path = self._cloudclient().subscription_path(project_id, name)
+        path = self._cloudclient().subscription_path(session.project_id, name)
         # Local import to avoid burdening AppEngine memory.
         # Loading all Cloud Client libraries would be 100MB  means that
         # the default AppEngine Instance crashes on out-of-memory even before actually serving a request.
@@ -80,16 +157,20 @@ class Subscriptions(Plugin):
         )
 
         update_mask = {"paths": {"labels"}}
+        return {"subscription": update_obj, "update_mask": update_mask}
 
+    @log_time
+    def label_resource(self, gcp_object: Dict, session):
+        request = self.__update_request(gcp_object, session)
+        if request is None:
+            return
+        self.__update(request)
+
+    def __update(self, request: Dict):
         with timing("update " + type(self).__name__):
-            _ = self._cloudclient().update_subscription(
-                request={
-                    "subscription": update_obj,
-                    "update_mask": update_mask,
-                }
-            )
+            _ = self._cloudclient().update_subscription(request=request)
 
-        logging.info(f"Updated: {path}")
+        logging.info(f"Updated: {request['subscription'].name}")
 
     def get_gcp_object(self, log_data):
         try:
@@ -15,16 +15,26 @@ set -e
 
 SCHEDULELABELING_TOPIC=iris_schedulelabeling_topic
 LABEL_ALL_TYPES_TOPIC=iris_label_all_types_topic
+LABEL_DEFERRED_TOPIC=iris_label_deferred_topic
 DEADLETTER_TOPIC=iris_deadletter_topic
 DEADLETTER_SUB=iris_deadletter
 DO_LABEL_SUBSCRIPTION=do_label
 LABEL_ONE_SUBSCRIPTION=label_one
+LABEL_DEFERRED_SUBSCRIPTION=label_deferred
 LABEL_ALL_TYPES_SUBSCRIPTION=label_all_types
 
 ACK_DEADLINE=60
+# do_label runs for up to do_label_time_budget_seconds, plus the sending of its last batches;
+# if it is not acknowledged in time, PubSub redelivers it, and both runs would resume labeling
+DO_LABEL_ACK_DEADLINE=600
 MAX_DELIVERY_ATTEMPTS=10
 MIN_RETRY=30s
 MAX_RETRY=600s
+# Deferred labeling (e.g. of CloudSQL, which takes minutes to initialize) is retried until the
+# resource is ready; keep these in sync with util/deferred_queue.py
+DEFERRED_MAX_DELIVERY_ATTEMPTS=20
+DEFERRED_MIN_RETRY=60s
+DEFERRED_MAX_RETRY=600s
 
 # Must have one of these config
 if [[ ! -f "config-test.yaml" ]] && [[ ! -f "config.yaml" ]]; then
@@ -59,6 +69,7 @@ fi
 gae_svc=$(grep "service:" app.yaml | awk '{print $2}')
 
 LABEL_ONE_SUBSCRIPTION_ENDPOINT="https://${gae_svc}-dot-${appengineHostname}/label_one"
+LABEL_DEFERRED_SUBSCRIPTION_ENDPOINT="https://${gae_svc}-dot-${appengineHostname}/label_deferred"
 DO_LABEL_SUBSCRIPTION_ENDPOINT="https://${gae_svc}-dot-${appengineHostname}/do_label"
 LABEL_ALL_TYPES_SUBSCRIPTION_ENDPOINT="https://${gae_svc}-dot-${appengineHostname}/label_all_types"
 
@@ -163,7 +174,7 @@ then
     --project="$PROJECT_ID" \
     --push-endpoint "$DO_LABEL_SUBSCRIPTION_ENDPOINT" \
     --push-auth-service-account $MSGSENDER_SERVICE_ACCOUNT \
-    --ack-deadline=$ACK_DEADLINE \
+    --ack-deadline=$DO_LABEL_ACK_DEADLINE \
     --max-delivery-attempts=$MAX_DELIVERY_ATTEMPTS \
     --dead-letter-topic=$DEADLETTER_TOPIC \
     --min-retry-delay=$MIN_RETRY \
@@ -174,7 +185,7 @@ else
     --topic "$SCHEDULELABELING_TOPIC" --project="$PROJECT_ID" \
     --push-endpoint "$DO_LABEL_SUBSCRIPTION_ENDPOINT" \
     --push-auth-service-account $MSGSENDER_SERVICE_ACCOUNT \
-    --ack-deadline=$ACK_DEADLINE \
+    --ack-deadline=$DO_LABEL_ACK_DEADLINE \
     --max-delivery-attempts=$MAX_DELIVERY_ATTEMPTS \
     --dead-letter-topic=$DEADLETTER_TOPIC \
     --min-retry-delay=$MIN_RETRY \
@@ -186,6 +197,8 @@ if [[ "$LABEL_ON_CREATION_EVENT" != "true" ]];
 then
   gcloud pubsub subscriptions delete "$LABEL_ONE_SUBSCRIPTION" --project="$PROJECT_ID" 2>/dev/null || true
   gcloud pubsub topics delete "$LOGS_TOPIC" --project="$PROJECT_ID" 2>/dev/null || true
+  gcloud pubsub subscriptions delete "$LABEL_DEFERRED_SUBSCRIPTION" --project="$PROJECT_ID" 2>/dev/null || true
+  gcloud pubsub topics delete "$LABEL_DEFERRED_TOPIC" --project="$PROJECT_ID" 2>/dev/null || true
 else
   # Create PubSub topic for receiving logs about new GCP objects
   gcloud pubsub topics describe "$LOGS_TOPIC" --project="$PROJECT_ID" &>/dev/null ||
@@ -216,6 +229,36 @@ else
       --quiet >/dev/null
   fi
 
+  # Create PubSub topic for resources whose labeling on creation waits until they are ready
+  gcloud pubsub topics describe "$LABEL_DEFERRED_TOPIC" --project="$PROJECT_ID" &>/dev/null ||
+    gcloud pubsub topics create $LABEL_DEFERRED_TOPIC --project="$PROJECT_ID" --quiet >/dev/null
+
+  # Create or update PubSub subscription for these. The endpoint fails while the resource
+  # is not ready, and the retry policy then redelivers with exponential backoff.
+  if gcloud pubsub subscriptions describe "$LABEL_DEFERRED_SUBSCRIPTION" --project="$PROJECT_ID" &>/dev/null ;
+  then
+    gcloud pubsub subscriptions update "$LABEL_DEFERRED_SUBSCRIPTION" --project="$PROJECT_ID" \
+      --push-endpoint="$LABEL_DEFERRED_SUBSCRIPTION_ENDPOINT" \
+      --push-auth-service-account $MSGSENDER_SERVICE_ACCOUNT \
+      --ack-deadline=$ACK_DEADLINE \
+      --max-delivery-attempts=$DEFERRED_MAX_DELIVERY_ATTEMPTS \
+      --dead-letter-topic=$DEADLETTER_TOPIC \
+      --min-retry-delay=$DEFERRED_MIN_RETRY \
+      --max-retry-delay=$DEFERRED_MAX_RETRY \
+      --quiet >/dev/null
+  else
+    gcloud pubsub subscriptions create "$LABEL_DEFERRED_SUBSCRIPTION" \
+      --topic "$LABEL_DEFERRED_TOPIC" --project="$PROJECT_ID" \
+      --push-endpoint="$LABEL_DEFERRED_SUBSCRIPTION_ENDPOINT" \
+      --push-auth-service-account $MSGSENDER_SERVICE_ACCOUNT \
+      --ack-deadline=$ACK_DEADLINE \
+      --max-delivery-attempts=$DEFERRED_MAX_DELIVERY_ATTEMPTS \
+      --dead-letter-topic=$DEADLETTER_TOPIC \
+      --min-retry-delay=$DEFERRED_MIN_RETRY \
+      --max-retry-delay=$DEFERRED_MAX_RETRY \
+      --quiet >/dev/null
+  fi
+
 fi
 
 gcloud pubsub topics describe "$LABEL_ALL_TYPES_TOPIC" --project="$PROJECT_ID" &>/dev/null ||
@@ -251,6 +294,10 @@ if [[ "$LABEL_ON_CREATION_EVENT" == "true" ]]; then
     --member="serviceAccount:$PUBSUB_SERVICE_ACCOUNT" \
     --role="roles/pubsub.subscriber" --project $PROJECT_ID >/dev/null
 
+  gcloud pubsub subscriptions add-iam-policy-binding $LABEL_DEFERRED_SUBSCRIPTION \
+    --member="serviceAccount:$PUBSUB_SERVICE_ACCOUNT" \
+    --role="roles/pubsub.subscriber" --project $PROJECT_ID >/dev/null
+
 fi
 
 gcloud pubsub subscriptions add-iam-policy-binding $LABEL_ALL_TYPES_SUBSCRIPTION \
@@ -0,0 +1,76 @@
+import glob
+import json
+import logging
+import time
+from string import Template
+
+from plugin import PluginHolder
+from test_scripts.utils_for_tests import assert_root_path
+from util.utils import init_logging
+
+init_logging()
+"""
+This is a microbenchmark used in development.
+It compares finding the plugin for the methodName of each log message in sample_data
+- by looping over all plugins and substring-matching their method names, as was done before, and
+- with the method index that PluginHolder builds in init().
+
+To use it, run this file in the project root (with a config.yaml in place), e.g.
+`PYTHONPATH=. python test_scripts/benchmark_method_dispatch.py`
+"""
+
+ROUNDS = 10_000
+
+
+def sample_method_names():
+    ret = []
+    for path in sorted(glob.glob("./sample_data/*.log_message.json")):
+        with open(path) as f:
+            json_s = Template(f.read()).substitute(
+                project="p", name="n", parent_name="parent", zone="us-east1-b"
+            )
+        ret.append(json.loads(json_s)["protoPayload"]["methodName"])
+    return ret
+
+
+def looping_dispatch(method_from_log):
+    """The per-message loop over plugins, as it was done before the method index"""
+    plugins_found = []
+    for plugin_cls in PluginHolder.plugin_classes():
+        for supported_method in plugin_cls.method_names():
+            if supported_method.lower() in method_from_log.lower():
+                plugins_found.append(plugin_cls)
+    if len(plugins_found) > 1:
+        raise Exception(f"Multiple plugins found {plugins_found} for {method_from_log}")
+    return plugins_found[0] if plugins_found else None
+
+
+def main():
+    PluginHolder.init()
+    method_names = sample_method_names()
+
+    start = time.time()
+    for _ in range(ROUNDS):
+        before = [looping_dispatch(m) for m in method_names]
+    looping_ms = int((time.time() - start) * 1000)
+
+    start = time.time()
+    for _ in range(ROUNDS):
+        after = [PluginHolder.plugin_cls_for_method(m) for m in method_names]
+    indexed_ms = int((time.time() - start) * 1000)
+
+    # noinspection PyUnboundLocalVariable
+    assert before == after, "Both ways of dispatching should find the same plugins"
+    logging.info(
+        "Dispatch of %d sample messages x %d rounds: looping %d ms; indexed %d ms (%.1fx faster)",
+        len(method_names),
+        ROUNDS,
+        looping_ms,
+        indexed_ms,
+        looping_ms / max(indexed_ms, 1),
+    )
+
+
+if __name__ == "__main__":
+    assert_root_path()
+    main()
@@ -0,0 +1,110 @@
+import logging
+import time
+import tracemalloc
+
+from plugins.instances import Instances
+from test_scripts.utils_for_tests import assert_root_path
+from util.gcp.gcp_utils import cloudclient_pb_obj_to_dict
+from util.utils import init_logging
+
+init_logging()
+"""
+This is a microbenchmark used in development.
+It compares converting many synthetic compute_v1.Instance objects to dicts
+- with all fields, marshalled through the Cloud Client objects, as was done before, and
+- with only the fields declared by the Instances plugin, read from the raw protobuf.
+
+It does not access the cloud. To use it, run this file in the project root, e.g.
+`PYTHONPATH=. python test_scripts/benchmark_pb_to_dict.py`
+"""
+
+OBJECT_COUNT = 20_000
+
+
+def synthetic_instances():
+    from google.cloud import compute_v1
+
+    zone = "https://www.googleapis.com/compute/v1/projects/p/zones/us-east1-b"
+    ret = []
+    for i in range(OBJECT_COUNT):
+        ret.append(
+            compute_v1.Instance(
+                name=f"instance-{i}",
+                zone=zone,
+                self_link=f"{zone}/instances/instance-{i}",
+                machine_type=f"{zone}/machineTypes/e2-medium",
+                label_fingerprint="42WmSpB8rSM=",
+                labels={"env": "prod", "team": f"team-{i % 10}"},
+                disks=[
+                    compute_v1.AttachedDisk(
+                        source=f"{zone}/disks/instance-{i}-{d}",
+                        device_name=f"disk-{d}",
+                        licenses=["https://www.googleapis.com/compute/v1/l"],
+                    )
+                    for d in range(2)
+                ],
+                network_interfaces=[
+                    compute_v1.NetworkInterface(
+                        network="global/networks/default",
+                        network_i_p=f"10.0.{i // 256 % 256}.{i % 256}",
+                    )
+                ],
+                metadata=compute_v1.Metadata(
+                    items=[
+                        compute_v1.Items(key=f"k{m}", value="v" * 100)
+                        for m in range(5)
+                    ]
+                ),
+            )
+        )
+    return ret
+
+
+def plain(value):
+    """Maps and repeated fields of Cloud Client objects, as built-in types"""
+    if hasattr(value, "items"):
+        return dict(value.items())
+    if hasattr(value, "__iter__") and not isinstance(value, str):
+        return list(value)
+    return value
+
+
+def convert(objects, fields):
+    tracemalloc.start()
+    start = time.time()
+    dicts = [cloudclient_pb_obj_to_dict(o, fields) for o in objects]
+    elapsed_ms = int((time.time() - start) * 1000)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dicts, elapsed_ms, peak // (1024 * 1024)
+
+
+def main():
+    objects = synthetic_instances()
+    fields = Instances._projected_fields()
+
+    full, full_ms, full_mb = convert(objects, None)
+    projected, projected_ms, projected_mb = convert(objects, fields)
+
+    for f, p in zip(full, projected):
+        for key, value in p.items():
+            assert plain(value) == plain(
+                f[key]
+            ), f"Both conversions should give the same {key}: {value} != {f[key]}"
+
+    logging.info(
+        "Converting %d Instances: all fields %d ms, peak %d MB; "
+        "projected to %s %d ms, peak %d MB (%.1fx faster)",
+        len(objects),
+        full_ms,
+        full_mb,
+        fields,
+        projected_ms,
+        projected_mb,
+        full_ms / max(projected_ms, 1),
+    )
+
+
+if __name__ == "__main__":
+    assert_root_path()
+    main()
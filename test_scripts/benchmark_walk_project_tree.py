@@ -0,0 +1,103 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+from test_scripts.utils_for_tests import assert_root_path
+from util.gcp.walk_project_tree import list_descendant_projects
+from util.utils import init_logging
+
+init_logging()
+"""
+This is a microbenchmark used in development.
+It walks a synthetic organization with fake resource-manager clients, which take
+LATENCY seconds per call, and compares
+- the recursive walk with a new thread pool per folder, as was done before, and
+- the breadth-first walk with one bounded pool in walk_project_tree.
+For each, it reports the time, and the most threads that were alive at once.
+
+To use it, run this file in the project root, e.g.
+`PYTHONPATH=. python test_scripts/benchmark_walk_project_tree.py`
+"""
+
+DEPTH = 4
+FOLDERS_PER_FOLDER = 5
+PROJECTS_PER_CONTAINER = 3
+LATENCY = 0.02
+
+Folder = namedtuple("Folder", "name")
+Project = namedtuple("Project", "project_id")
+
+
+class FakeFoldersClient:
+    def list_folders(self, parent, retry=None):
+        time.sleep(LATENCY)
+        depth = parent.count("-") if parent.startswith("folders/") else 0
+        if depth >= DEPTH:
+            return []
+        suffix = parent.partition("/")[2]
+        return [Folder(f"folders/{suffix}-{i}") for i in range(FOLDERS_PER_FOLDER)]
+
+
+class FakeProjectsClient:
+    def list_projects(self, parent, retry=None):
+        time.sleep(LATENCY)
+        suffix = parent.partition("/")[2]
+        return [Project(f"p-{suffix}-{i}") for i in range(PROJECTS_PER_CONTAINER)]
+
+
+folders_client = FakeFoldersClient()
+projects_client = FakeProjectsClient()
+
+
+def nested_pools_walk(container):
+    """The recursive walk, as it was done before, with fake clients"""
+    folders = [f.name for f in folders_client.list_folders(parent=container)]
+    projects = [p.project_id for p in projects_client.list_projects(parent=container)]
+    with ThreadPoolExecutor() as executor:
+        descendants = list(chain(*executor.map(nested_pools_walk, folders)))
+    return projects + descendants
+
+
+def measure(walk):
+    max_threads = threading.active_count()
+    done = threading.Event()
+
+    def sample_threads():
+        nonlocal max_threads
+        while not done.wait(0.005):
+            max_threads = max(max_threads, threading.active_count())
+
+    sampler = threading.Thread(target=sample_threads)
+    sampler.start()
+    start = time.time()
+    projects = list(walk())
+    elapsed_ms = int((time.time() - start) * 1000)
+    done.set()
+    sampler.join()
+    return projects, elapsed_ms, max_threads - 1  # Not counting the sampler
+
+
+def main():
+    org = "organizations/1"
+    before, before_ms, before_threads = measure(lambda: nested_pools_walk(org))
+    after, after_ms, after_threads = measure(
+        lambda: list_descendant_projects(org, folders_client, projects_client)
+    )
+    assert sorted(before) == sorted(after), "Both walks should find the same projects"
+    logging.info(
+        "Walking %d projects: nested pools %d ms, up to %d threads; "
+        "one bounded pool %d ms, up to %d threads",
+        len(after),
+        before_ms,
+        before_threads,
+        after_ms,
+        after_threads,
+    )
+
+
+if __name__ == "__main__":
+    assert_root_path()
+    main()
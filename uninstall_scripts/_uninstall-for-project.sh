@@ -10,10 +10,12 @@ set -e
 
 SCHEDULELABELING_TOPIC=iris_schedulelabeling_topic
 LABEL_ALL_TYPES_TOPIC=iris_label_all_types_topic
+LABEL_DEFERRED_TOPIC=iris_label_deferred_topic
 DEADLETTER_TOPIC=iris_deadletter_topic
 DEADLETTER_SUB=iris_deadletter
 DO_LABEL_SUBSCRIPTION=do_label
 LABEL_ONE_SUBSCRIPTION=label_one
+LABEL_DEFERRED_SUBSCRIPTION=label_deferred
 LABEL_ALL_TYPES_SUBSCRIPTION=label_all_types
 
 project_number=$(gcloud projects describe $PROJECT_ID --format json|jq -r '.projectNumber')
@@ -31,6 +33,10 @@ gcloud pubsub subscriptions remove-iam-policy-binding $LABEL_ONE_SUBSCRIPTION \
     --member="serviceAccount:$PUBSUB_SERVICE_ACCOUNT"\
     --role="roles/pubsub.subscriber" --project $PROJECT_ID >/dev/null   ||true
 
+gcloud pubsub subscriptions remove-iam-policy-binding $LABEL_DEFERRED_SUBSCRIPTION \
+    --member="serviceAccount:$PUBSUB_SERVICE_ACCOUNT"\
+    --role="roles/pubsub.subscriber" --project $PROJECT_ID >/dev/null   ||true
+
 gcloud pubsub subscriptions remove-iam-policy-binding $LABEL_ALL_TYPES_SUBSCRIPTION \
     --member="serviceAccount:$PUBSUB_SERVICE_ACCOUNT"\
     --role="roles/pubsub.subscriber" --project $PROJECT_ID >/dev/null  ||true
@@ -43,10 +49,12 @@ gcloud pubsub subscriptions remove-iam-policy-binding $LABEL_ALL_TYPES_SUBSCRIPT
 gcloud pubsub subscriptions delete $DEADLETTER_SUB --project="$PROJECT_ID" -q >/dev/null  || true
 gcloud pubsub subscriptions delete "$DO_LABEL_SUBSCRIPTION" -q --project="$PROJECT_ID" >/dev/null  || true
 gcloud pubsub subscriptions delete "$LABEL_ONE_SUBSCRIPTION" --project="$PROJECT_ID" >/dev/null   || true
+gcloud pubsub subscriptions delete "$LABEL_DEFERRED_SUBSCRIPTION" --project="$PROJECT_ID" >/dev/null   || true
 gcloud pubsub subscriptions delete "$LABEL_ALL_TYPES_SUBSCRIPTION" --project="$PROJECT_ID" >/dev/null   || true
 
 gcloud pubsub topics delete "$SCHEDULELABELING_TOPIC" --project="$PROJECT_ID" -q >/dev/null   ||true
 gcloud pubsub topics delete "$LABEL_ALL_TYPES_TOPIC" --project="$PROJECT_ID" -q >/dev/null   || true
+gcloud pubsub topics delete "$LABEL_DEFERRED_TOPIC" --project="$PROJECT_ID" -q >/dev/null   || true
 gcloud pubsub topics delete "$DEADLETTER_TOPIC" --project="$PROJECT_ID" -q >/dev/null   || true
 gcloud pubsub topics delete "$LOGS_TOPIC" --project="$PROJECT_ID"   >/dev/null  || true
 
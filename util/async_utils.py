@@ -0,0 +1,35 @@
+"""
+Support for the asyncio labeling mode (async_labeling in the config), in which
+plugins keep many API calls in flight on an event loop, rather than one per thread.
+"""
+import asyncio
+import threading
+import weakref
+from typing import Dict
+
+# Calls in flight to each API, across all plugins and projects labeled on one event loop
+API_CONCURRENCY = {
+    "pubsub": 100,
+    "sqladmin": 10,
+}
+DEFAULT_API_CONCURRENCY = 20
+
+# For each event loop, a semaphore per API
+__semaphores = weakref.WeakKeyDictionary()
+__lock = threading.Lock()
+
+
+def api_semaphore(api: str) -> asyncio.Semaphore:
+    """
+    :param api: the API name, as in a Discovery API, e.g. "pubsub"
+    :return the semaphore that limits calls to the API on the running event loop.
+    Use this within a coroutine, since each event loop (e.g., each asyncio.run
+    in a request) has its own semaphores.
+    """
+    loop = asyncio.get_running_loop()
+    with __lock:
+        semaphores: Dict[str, asyncio.Semaphore] = __semaphores.setdefault(loop, {})
+        if api not in semaphores:
+            limit = API_CONCURRENCY.get(api, DEFAULT_API_CONCURRENCY)
+            semaphores[api] = asyncio.Semaphore(limit)
+        return semaphores[api]
@@ -0,0 +1,104 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+# Error codes, as gRPC status names, on which a write is retried
+RETRIED_GRPC_CODES = {
+    "INTERNAL",
+    "UNAVAILABLE",
+    "DEADLINE_EXCEEDED",
+    "RESOURCE_EXHAUSTED",
+}
+
+
+def _is_transient(e: Exception) -> bool:
+    """Errors of Cloud Client calls, or of the gRPC layer under them (like
+    InactiveRpcError), which may succeed on retry"""
+    from google.api_core import exceptions
+
+    if isinstance(
+        e,
+        (
+            exceptions.InternalServerError,
+            exceptions.ServiceUnavailable,
+            exceptions.DeadlineExceeded,
+            exceptions.TooManyRequests,
+        ),
+    ):
+        return True
+    code = getattr(e, "code", None)  # grpc.RpcError
+    if callable(code):
+        try:
+            return code().name in RETRIED_GRPC_CODES
+        except Exception:
+            return False
+    return False
+
+
+class ConcurrentWriter:
+    """
+    Runs write calls on a thread pool, with up to max_in_flight at a time; submit blocks
+    while that many are in flight. Calls that fail with a transient error are retried with
+    exponential backoff and jitter. Use as a context manager: on exit, it waits for all
+    calls, and logs how many succeeded and failed.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_in_flight: int = 16,
+        max_attempts: int = 4,
+        initial_backoff: float = 1.0,
+    ):
+        self.__name = name
+        self.__max_attempts = max_attempts
+        self.__initial_backoff = initial_backoff
+        self.__executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.__slots = threading.BoundedSemaphore(max_in_flight)
+        self.__lock = threading.Lock()
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__executor.shutdown(wait=True)
+        logging.info(
+            "Writes for %s: %d succeeded, %d failed, %d retries",
+            self.__name,
+            self.succeeded,
+            self.failed,
+            self.retried,
+        )
+
+    def submit(self, func: Callable, *args):
+        self.__slots.acquire()
+        try:
+            future = self.__executor.submit(self.__call_with_retry, func, *args)
+        except Exception:
+            self.__slots.release()
+            raise
+        future.add_done_callback(lambda _: self.__slots.release())
+
+    def __call_with_retry(self, func: Callable, *args):
+        for attempt in range(1, self.__max_attempts + 1):
+            try:
+                func(*args)
+                with self.__lock:
+                    self.succeeded += 1
+                return
+            except Exception as e:
+                if attempt == self.__max_attempts or not _is_transient(e):
+                    logging.exception("Write failed after %d attempts", attempt)
+                    with self.__lock:
+                        self.failed += 1
+                    return
+                with self.__lock:
+                    self.retried += 1
+                backoff = self.__initial_backoff * 2 ** (attempt - 1)
+                time.sleep(backoff * random.uniform(0.5, 1.5))
@@ -61,6 +61,75 @@ def label_all_on_cron() -> bool:
     return ret
 
 
+def gce_aggregated_list() -> bool:
+    config = get_config()
+    ret = config.get("gce_aggregated_list", True)
+    assert isinstance(ret, bool), ret
+    return ret
+
+
+def filter_labeled_on_list() -> bool:
+    config = get_config()
+    ret = config.get("filter_labeled_on_list", False)
+    assert isinstance(ret, bool), ret
+    return ret
+
+
+def do_label_time_budget_seconds() -> int:
+    config = get_config()
+    ret = config.get("do_label_time_budget_seconds", 45)
+    assert isinstance(ret, int) and ret > 0, ret
+    return ret
+
+
+def async_labeling() -> bool:
+    config = get_config()
+    ret = config.get("async_labeling", False)
+    assert isinstance(ret, bool), ret
+    return ret
+
+
+def do_label_max_pack_size() -> int:
+    config = get_config()
+    ret = config.get("do_label_max_pack_size", 20)
+    assert isinstance(ret, int) and ret >= 1, ret
+    return ret
+
+
+def label_one_dedup_seconds() -> int:
+    config = get_config()
+    ret = config.get("label_one_dedup_seconds", 300)
+    assert isinstance(ret, int) and ret >= 0, ret
+    return ret
+
+
+def hierarchy_snapshot_ttl_seconds() -> int:
+    config = get_config()
+    ret = config.get("hierarchy_snapshot_ttl_seconds", 6 * 3600)
+    assert isinstance(ret, int) and ret >= 0, ret
+    return ret
+
+
+def zone_usage_ttl_seconds() -> int:
+    config = get_config()
+    ret = config.get("zone_usage_ttl_seconds", 7 * 24 * 3600)
+    assert isinstance(ret, int) and ret >= 0, ret
+    return ret
+
+
+def warm_up_plugins() -> typing.List[str]:
+    config = get_config()
+    ret = config.get("warm_up_plugins", [])
+    assert isinstance(ret, list) and all(re.match(r"[a-z]+", p) for p in ret), ret
+    return ret
+
+
+def state_store_location() -> str:
+    """Empty string if no state is persisted across runs"""
+    config = get_config()
+    return config.get("state_store") or ""
+
+
 @functools.lru_cache
 def get_config() -> typing.Dict:
     test_config_file = "config-test.yaml"
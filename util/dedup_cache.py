@@ -0,0 +1,110 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+# States of a key: claimed by a request that is handling the event, or handled
+PENDING = "pending"
+DONE = "done"
+
+
+class DedupCache:
+    """
+    Remembers keys for a time window, so that repeated deliveries of
+    the same event within the window can be dropped.
+
+    A request claims the key before handling the event, so that near-simultaneous
+    duplicates see it as pending. It marks the key done once the event is handled,
+    or releases it if that failed, so that a later delivery can try again.
+
+    Keys are kept in-process. If shared, they are also kept in App Engine Memcache,
+    so that a duplicate delivered to another instance is dropped too; claims are then
+    atomic across instances, through Memcache add. Memcache is best-effort:
+    if it fails, only the in-process cache is used. Outside App Engine, use
+    shared=False; the in-process cache then stands in for the shared one.
+    """
+
+    def __init__(self, window_seconds: int, shared: bool = False, maxsize: int = 10000):
+        self.__window = window_seconds
+        self.__shared = shared
+        self.__maxsize = maxsize
+        # Expiration and state, for each key
+        self.__entries: OrderedDict[str, Tuple[float, str]] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def __memcache_key(key):
+        # Memcache keys are limited to 250 bytes
+        return "iris-dedup-" + hashlib.sha1(key.encode()).hexdigest()
+
+    def __evict(self, now):
+        # Entries all have the same window, so the oldest are at the front
+        while self.__entries and (
+            len(self.__entries) > self.__maxsize
+            or next(iter(self.__entries.values()))[0] <= now
+        ):
+            self.__entries.popitem(last=False)
+
+    def __put(self, key, state):
+        now = time.time()
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = (now + self.__window, state)
+            self.__evict(now)
+
+    def claim(self, key: str) -> Optional[str]:
+        """
+        Claim the key as pending, unless it was claimed within the window.
+        :return None if this call claimed the key; otherwise the state of the
+        earlier claim, PENDING or DONE
+        """
+        if self.__window <= 0:
+            return None
+        now = time.time()
+        with self.__lock:
+            self.__evict(now)
+            entry = self.__entries.get(key)
+            if entry is not None:
+                return entry[1]
+            self.__entries[key] = (now + self.__window, PENDING)
+        if self.__shared:
+            try:
+                from google.appengine.api import memcache
+
+                mc_key = self.__memcache_key(key)
+                if not memcache.add(mc_key, PENDING, time=self.__window):
+                    # Claimed by another instance
+                    with self.__lock:
+                        self.__entries.pop(key, None)
+                    return memcache.get(mc_key) or PENDING
+            except Exception:
+                logging.exception("Memcache add failed; using in-process cache only")
+        return None
+
+    def mark_done(self, key: str):
+        if self.__window <= 0:
+            return
+        self.__put(key, DONE)
+        if self.__shared:
+            try:
+                from google.appengine.api import memcache
+
+                memcache.set(self.__memcache_key(key), DONE, time=self.__window)
+            except Exception:
+                logging.exception("Memcache set failed; using in-process cache only")
+
+    def release(self, key: str):
+        """Drop the claim, so that a later delivery of the event is handled"""
+        if self.__window <= 0:
+            return
+        with self.__lock:
+            self.__entries.pop(key, None)
+        if self.__shared:
+            try:
+                from google.appengine.api import memcache
+
+                memcache.delete(self.__memcache_key(key))
+            except Exception:
+                logging.exception("Memcache delete failed")
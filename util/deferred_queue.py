@@ -0,0 +1,70 @@
+import json
+import logging
+import threading
+from abc import ABCMeta, abstractmethod
+from typing import Callable, Dict
+
+from util import pubsub_utils
+
+# The delays before rechecking whether a deferred resource is ready, doubling from the
+# min to the max, as in the retry policy of the label_deferred subscription in _deploy-project.sh
+MIN_DELAY_SECONDS = 60
+MAX_DELAY_SECONDS = 600
+# As max-delivery-attempts of that subscription; CloudSQL instances take several minutes to be ready
+MAX_ATTEMPTS = 20
+
+
+class DeferredQueue(metaclass=ABCMeta):
+    """
+    Resources that cannot be labeled as soon as their creation is logged, like CloudSQL
+    instances, which are PENDING_CREATE for minutes, are parked in this queue.
+    The creation log message is rechecked, with exponentially growing delays, until
+    the resource is ready and labeled, or until it has been tried MAX_ATTEMPTS times.
+    """
+
+    @abstractmethod
+    def defer(self, data: Dict):
+        """:param data: the log message of the creation, as received in label_one"""
+        pass
+
+
+class PubSubDeferredQueue(DeferredQueue):
+    """
+    Publishes to the topic of the label_deferred subscription, which pushes to the
+    /label_deferred endpoint. That endpoint responds with an error while the resource
+    is not ready, and the retry policy of the subscription then redelivers later.
+    """
+
+    def defer(self, data: Dict):
+        pubsub_utils.publish(json.dumps(data), pubsub_utils.label_deferred_topic())
+
+
+class LocalDeferredQueue(DeferredQueue):
+    """
+    Rechecks on timers in this process, for local development and testing,
+    where Pub/Sub cannot push to the endpoint.
+    """
+
+    def __init__(self, handler: Callable[[Dict], bool]):
+        """:param handler: labels the resource of a log message, as /label_deferred does;
+        returns False if the resource is not yet ready"""
+        self.__handler = handler
+
+    def defer(self, data: Dict):
+        self.__schedule(data, 1, MIN_DELAY_SECONDS)
+
+    def __schedule(self, data: Dict, attempt: int, delay: float):
+        timer = threading.Timer(delay, self.__try, args=(data, attempt, delay))
+        timer.daemon = True
+        timer.start()
+
+    def __try(self, data: Dict, attempt: int, delay: float):
+        try:
+            if self.__handler(data):
+                return
+        except Exception:
+            logging.exception("Deferred labeling failed, attempt %d", attempt)
+        if attempt >= MAX_ATTEMPTS:
+            logging.error("Giving up deferred labeling after %d attempts", attempt)
+        else:
+            self.__schedule(data, attempt + 1, min(delay * 2, MAX_DELAY_SECONDS))
@@ -1,11 +1,13 @@
 import logging
 import os
 import re
+import threading
 import uuid
 from collections import Counter
 from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, Any
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Tuple
 from zoneinfo import ZoneInfo
 
 from google.appengine.api.runtime import memory_usage
@@ -13,7 +15,14 @@ from google.appengine.api.runtime import memory_usage
 from util import localdev_config, utils
 from util.gcp.detect_gae import detect_gae
 from util.gcp.walk_project_tree import list_descendant_projects
-from util.utils import timed_lru_cache, log_time, dict_to_camelcase, sort_dict
+from util.utils import (
+    ttl_cache,
+    log_time,
+    dict_to_camelcase,
+    sort_dict,
+    to_camel_case,
+    to_snake_case,
+)
 
 __invocation_count = Counter()
 
@@ -60,11 +69,22 @@ def is_appscript_project(p) -> bool:
     return bool(re.match(r"sys-\d{26}", p))
 
 
-# Not cached.
 @log_time
-def all_projects():  #
-    """All projects to which the current user has access
-    Returns a generator."""
+def all_projects() -> List[str]:
+    """All projects in the organization of the current project, as kept
+    in the hierarchy snapshot, which is refreshed when stale."""
+    # Local import because hierarchy_snapshot imports this module (through state_store)
+    from util.gcp import hierarchy_snapshot
+
+    current_proj_id = current_project_id()
+    _, projects = hierarchy_snapshot.org_and_projects(
+        current_proj_id, lambda: __walk_org(current_proj_id)
+    )
+    return projects
+
+
+def __walk_org(current_proj_id) -> Tuple[str, List[str]]:
+    """:return the organization of the current project, and all projects in it"""
     # We do local import to avoid burdening AppEngine memory.
     # Loading all Cloud Client libraries would be 100MB  means that
     # the default AppEngine Instance crashes on out-of-memory even before actually serving a request.
@@ -73,15 +93,14 @@ def all_projects():  #
     add_loaded_lib("resourcemanager_v3")
     projects_client = resourcemanager_v3.ProjectsClient()
 
-    current_proj_id = current_project_id()
     current_project = projects_client.get_project(
         None, name=f"projects/{current_proj_id}"
     )
     parent_name = current_project.name
     org_name = get_org(parent_name)
 
-    projects = list_descendant_projects(org_name)
-    return projects
+    projects = list(list_descendant_projects(org_name))
+    return org_name, projects
 
 
 def method_name(projects):
@@ -89,7 +108,8 @@ def method_name(projects):
 
 
 @log_time
-@timed_lru_cache(maxsize=250, seconds=600)
+# The organization of a project rarely changes, so a stale value is used while reloading
+@ttl_cache(seconds=600, maxsize=250, stale_seconds=3600)
 def get_org(proj_name):
     projects_client = __create_project_client()
     folders_client = __create_folder_client()
@@ -138,21 +158,102 @@ def __create_project_client():
     return projects_client
 
 
-@timed_lru_cache(maxsize=200, seconds=600)
 def get_project(project_id: str) -> Dict[str, Any]:
+    """Not cached; see project_metadata for the cache of project labels"""
     proj = __create_project_client().get_project(name=f"projects/{project_id}")
     proj_as_dict = {"labels": proj.labels}  # This is the only key actually used
     return proj_as_dict
 
 
-def cloudclient_pb_objects_to_list_of_dicts(objects):
-    return (cloudclient_pb_obj_to_dict(i) for i in objects)
+def cloudclient_pb_objects_to_list_of_dicts(
+    objects, fields: Optional[Tuple[str, ...]] = None
+):
+    return (cloudclient_pb_obj_to_dict(i, fields) for i in objects)
+
+
+def cloudclient_pb_obj_to_dict(
+    o, fields: Optional[Tuple[str, ...]] = None
+) -> Dict[str, Any]:
+    """
+    :param fields: camelCase names of the fields to convert, or None for all fields.
+    With fields, scalars, repeated scalars and maps of scalars are read from the raw
+    protobuf, skipping the marshalling of Cloud Client (proto-plus) objects;
+    other fields still go through it.
+    Names which are not fields of o are ignored.
+    """
+    if fields is None:
+        keys = o.__dict__["_pb"].DESCRIPTOR.fields_by_name.keys()
+        object_as_dict = {key: getattr(o, key) for key in keys}
+        return dict_to_camelcase(object_as_dict)
+
+    pb = o.__dict__["_pb"]
+    ret = {}
+    for camel_key, snake_key, kind in __projection(pb.DESCRIPTOR, fields):
+        if kind == __RAW:
+            ret[camel_key] = getattr(pb, snake_key)
+        elif kind == __RAW_REPEATED:
+            ret[camel_key] = list(getattr(pb, snake_key))
+        elif kind == __RAW_MAP:
+            ret[camel_key] = dict(getattr(pb, snake_key))
+        else:
+            ret[camel_key] = getattr(o, snake_key)
+    return ret
+
+
+__RAW, __RAW_REPEATED, __RAW_MAP, __MARSHALLED = range(4)
 
 
-def cloudclient_pb_obj_to_dict(o) -> Dict[str, str]:
-    keys = o.__dict__["_pb"].DESCRIPTOR.fields_by_name.keys()
-    object_as_dict = {key: getattr(o, key) for key in keys}
-    return dict_to_camelcase(object_as_dict)
+@lru_cache(maxsize=256)
+def __projection(
+    descriptor, fields: Tuple[str, ...]
+) -> Tuple[Tuple[str, str, int], ...]:
+    """:return for each of the fields that exist in the message type,
+    its camelCase key, snake_case name, and how to read it"""
+    ret = []
+    for camel_key in fields:
+        snake_key = to_snake_case(camel_key)
+        field = descriptor.fields_by_name.get(snake_key)
+        if field is None:
+            continue
+        assert to_camel_case(snake_key) == camel_key, camel_key
+        ret.append((camel_key, snake_key, __field_kind(field)))
+    return tuple(ret)
+
+
+def __field_kind(field) -> int:
+    # Enums are marshalled to enum members, and messages to Cloud Client objects
+    is_scalar = field.message_type is None and field.enum_type is None
+    if field.message_type is not None and field.message_type.GetOptions().map_entry:
+        value_field = field.message_type.fields_by_name["value"]
+        if value_field.message_type is None and value_field.enum_type is None:
+            return __RAW_MAP
+        return __MARSHALLED
+    if not is_scalar:
+        return __MARSHALLED
+    if field.label == field.LABEL_REPEATED:
+        return __RAW_REPEATED
+    return __RAW
+
+
+__thread_local = threading.local()
+
+
+def thread_local_http():
+    """
+    An authorized HTTP object for the current thread, to pass to execute() of
+    Google API Client requests made on several threads, since the HTTP object
+    that a Google API Client shares is not thread-safe.
+    """
+    http = getattr(__thread_local, "http", None)
+    if http is None:
+        import google.auth
+        import google_auth_httplib2
+        import httplib2
+
+        credentials, _ = google.auth.default()
+        http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+        __thread_local.http = http
+    return http
 
 
 __inst_id = utils.random_str(6)
@@ -182,6 +283,19 @@ def log_gae_memory(tag):
             logging.exception("")
 
 
+def current_mem_usage_mb() -> int:
+    """:return the memory of this process in MB, as App Engine reports it or, elsewhere,
+    as the resident set size; -1 if unknown"""
+    if detect_gae():
+        return __current_mem_usage_gae()
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return round(resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20)
+    except Exception:  # Not Linux
+        return -1
+
+
 def __current_mem_usage_gae() -> int:
     if detect_gae():
         try:
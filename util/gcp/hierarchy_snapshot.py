@@ -0,0 +1,65 @@
+"""
+Snapshot of the organization and its projects, so that all_projects need not
+walk the folder tree on every call. The snapshot is kept in-process and, if a state
+store is configured, in the store, where all App Engine instances share it.
+It is replaced by a full walk once older than hierarchy_snapshot_ttl_seconds.
+"""
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from util.config_utils import hierarchy_snapshot_ttl_seconds
+from util.state_store import state_store
+
+__lock = threading.Lock()
+__snapshot: Optional[Dict] = None
+
+
+def __doc_key(current_project_id: str) -> str:
+    return f"hierarchy_snapshot/{current_project_id}"
+
+
+def __is_fresh(doc: Optional[Dict]) -> bool:
+    ttl = hierarchy_snapshot_ttl_seconds()
+    return doc is not None and time.time() < doc["time"] + ttl
+
+
+def __load_or_walk(
+    current_project_id: str, walk: Callable[[], Tuple[str, List[str]]]
+) -> Dict:
+    store = state_store()
+    if store is not None:
+        try:
+            doc = store.get(__doc_key(current_project_id))
+            if __is_fresh(doc):
+                return doc
+        except Exception:
+            logging.exception("Cannot load hierarchy snapshot")
+
+    org_name, project_ids = walk()
+    doc = {"org": org_name, "projects": list(project_ids), "time": time.time()}
+    logging.info(
+        "Walked hierarchy of %s: %d projects", org_name, len(doc["projects"])
+    )
+    if store is not None:
+        try:
+            store.put(__doc_key(current_project_id), doc)
+        except Exception:
+            logging.exception("Cannot save hierarchy snapshot")
+    return doc
+
+
+def org_and_projects(
+    current_project_id: str, walk: Callable[[], Tuple[str, List[str]]]
+) -> Tuple[str, List[str]]:
+    """
+    :param walk: lists the organization of the current project, and all projects in it
+    :return the organization name and project IDs, from a snapshot if it is fresh enough
+    """
+    global __snapshot
+    # Held during a walk, so that concurrent callers wait for it rather than walk as well
+    with __lock:
+        if not __is_fresh(__snapshot):
+            __snapshot = __load_or_walk(current_project_id, walk)
+        return __snapshot["org"], list(__snapshot["projects"])
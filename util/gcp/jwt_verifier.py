@@ -0,0 +1,100 @@
+"""
+Verification of the Google-signed ID tokens (JWTs) that PubSub sends with push requests,
+without an outbound request per push: Google's public certificates are cached as long as
+their Cache-Control header allows, and already-verified tokens are cached until they expire.
+"""
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+GOOGLE_OAUTH2_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+
+
+class IdTokenVerifier:
+    def __init__(
+        self,
+        certs_url: str = GOOGLE_OAUTH2_CERTS_URL,
+        default_certs_ttl: int = 300,
+        max_cached_tokens: int = 1000,
+    ):
+        """
+        :param certs_url: Where to get the certificates (key id to PEM). Can point to a local stub in testing.
+        :param default_certs_ttl: How long to keep the certificates if the response has no max-age.
+        """
+        self.__certs_url = certs_url
+        self.__default_certs_ttl = default_certs_ttl
+        self.__max_cached_tokens = max_cached_tokens
+        self.__session = None
+        self.__certs: Optional[Dict[str, str]] = None
+        self.__certs_expiration = 0.0
+        self.__certs_lock = threading.Lock()
+        # Hash of token -> (claims, expiration)
+        self.__verified: OrderedDict[str, Tuple[Dict, float]] = OrderedDict()
+        self.__verified_lock = threading.Lock()
+
+    def __fetch_certs(self):
+        if self.__session is None:
+            import requests
+
+            # One pooled session, rather than a new transport per verification
+            self.__session = requests.Session()
+        resp = self.__session.get(self.__certs_url, timeout=10)
+        resp.raise_for_status()
+        cache_control = resp.headers.get("Cache-Control", "")
+        max_age_match = re.search(r"max-age=(\d+)", cache_control)
+        if max_age_match:
+            ttl = int(max_age_match.group(1)) - int(resp.headers.get("Age", 0))
+        else:
+            ttl = self.__default_certs_ttl
+        self.__certs = resp.json()
+        self.__certs_expiration = time.time() + max(ttl, 0)
+        logging.info("Fetched certificates for ID tokens; valid for %d s", ttl)
+
+    def __get_certs(self, force_refresh=False) -> Dict[str, str]:
+        with self.__certs_lock:
+            if (
+                force_refresh
+                or self.__certs is None
+                or time.time() >= self.__certs_expiration
+            ):
+                self.__fetch_certs()
+            return self.__certs
+
+    def __decode(self, token) -> Dict:
+        from google.auth import jwt
+
+        try:
+            return jwt.decode(token, certs=self.__get_certs())
+        except ValueError as e:
+            if "Certificate for key id" not in str(e):
+                raise
+            # Google may have rotated its keys before our cached certificates expired
+            return jwt.decode(token, certs=self.__get_certs(force_refresh=True))
+
+    def verify(self, token: str) -> Dict:
+        """
+        :return the claims of the token
+        :raise ValueError (or another Exception) if the token is not valid
+        """
+        token_hash = hashlib.sha256(token.encode()).hexdigest()
+        now = time.time()
+        with self.__verified_lock:
+            cached = self.__verified.get(token_hash)
+            if cached is not None and cached[1] > now:
+                self.__verified.move_to_end(token_hash)
+                return cached[0]
+
+        claims = self.__decode(token)
+        if claims.get("iss") not in GOOGLE_ISSUERS:
+            raise ValueError(f"Wrong issuer {claims.get('iss')}")
+
+        with self.__verified_lock:
+            self.__verified[token_hash] = (claims, float(claims["exp"]))
+            while len(self.__verified) > self.__max_cached_tokens:
+                self.__verified.popitem(last=False)
+        return claims
@@ -0,0 +1,79 @@
+"""
+The labels of projects, for copying onto resources (from_project in the config).
+One cache serves all plugins in this process. /schedule fills it for all enabled projects
+with one search, and passes the labels of each project in its do_label messages, so that
+do_label need not get each project from the Resource Manager.
+"""
+import logging
+from typing import Dict, Iterable
+
+from util.gcp import gcp_utils
+from util.gcp.gcp_utils import add_loaded_lib
+from util.utils import TtlCache, timing
+
+# Labels of a project are used for this long after they were fetched, and for a while
+# longer, while they are fetched again in the background
+LABELS_TTL_SECONDS = 600
+LABELS_STALE_SECONDS = 600
+
+__cache = TtlCache(
+    "project_labels",
+    LABELS_TTL_SECONDS,
+    maxsize=20000,
+    stale_seconds=LABELS_STALE_SECONDS,
+)
+
+
+def put(labels_by_project: Dict[str, Dict[str, str]]):
+    """Add labels fetched elsewhere, as passed in a do_label message"""
+    for project_id, labels in labels_by_project.items():
+        __cache.put(project_id, dict(labels))
+
+
+def cached(project_ids: Iterable[str]) -> Dict[str, Dict[str, str]]:
+    """:return the labels of those projects that are in the cache and fresh"""
+    ret = {}
+    for project_id in project_ids:
+        labels = __cache.peek(project_id)
+        if labels is not None:
+            ret[project_id] = dict(labels)
+    return ret
+
+
+def __get_labels(project_id: str) -> Dict[str, str]:
+    return dict(gcp_utils.get_project(project_id)["labels"])
+
+
+def project_labels(project_id: str) -> Dict[str, str]:
+    """:return the labels of the project, getting the project if they are not cached"""
+    try:
+        return dict(__cache.get(project_id, lambda: __get_labels(project_id)))
+    except Exception:
+        logging.exception("Failing to get labels for project %s", project_id)
+        return {}
+
+
+def prefetch(project_ids: Iterable[str]) -> Dict[str, Dict[str, str]]:
+    """
+    Fill the cache with the labels of the projects, with a single search over
+    all projects that Iris can see.
+    :return the labels of each of the projects, where found
+    """
+    project_ids = set(project_ids)
+    # Local import to avoid burdening AppEngine memory.
+    # Loading all Cloud Client libraries would be 100MB  means that
+    # the default AppEngine Instance crashes on out-of-memory even before actually serving a request.
+    from google.cloud import resourcemanager_v3
+
+    add_loaded_lib("resourcemanager_v3")
+    found = {}
+    with timing("prefetch project labels"):
+        projects = resourcemanager_v3.ProjectsClient().search_projects(
+            query="state:ACTIVE"
+        )
+        for project in projects:
+            if project.project_id in project_ids:
+                found[project.project_id] = dict(project.labels)
+    put(found)
+    logging.info("Prefetched labels of %d of %d projects", len(found), len(project_ids))
+    return found
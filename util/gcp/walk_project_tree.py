@@ -1,39 +1,103 @@
-from concurrent.futures import ThreadPoolExecutor
-from itertools import chain
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
+from typing import Iterator, List
 
-from google.cloud import resourcemanager_v3
+# List calls at a time, on one pool, whatever the depth of the tree
+MAX_WORKERS = 16
 
-folders_client = resourcemanager_v3.FoldersClient()
-proj_client = resourcemanager_v3.ProjectsClient()
 
+@lru_cache(maxsize=1)
+def __default_clients():
+    # Local import to avoid burdening AppEngine memory.
+    # Loading all Cloud Client libraries would be 100MB  means that
+    # the default AppEngine Instance crashes on out-of-memory even before actually serving a request.
+    from google.cloud import resourcemanager_v3
 
-def list_descendant_projects(container):
-    """return iterator of project IDs, without "projects/" prefix"""
-    return filter(lambda n: not n.startswith("folders/"), _list_descendants(container))
+    # Local import, since gcp_utils imports this module
+    from util.gcp.gcp_utils import add_loaded_lib
 
+    add_loaded_lib("resourcemanager_v3")
+    return resourcemanager_v3.FoldersClient(), resourcemanager_v3.ProjectsClient()
 
-def _list_descendants(container):
-    """container: org or folder"""
+
+@lru_cache(maxsize=1)
+def __retry():
+    from google.api_core import exceptions
+    from google.api_core.retry import Retry, if_exception_type
+
+    return Retry(
+        predicate=if_exception_type(
+            exceptions.TooManyRequests,
+            exceptions.ServiceUnavailable,
+            exceptions.InternalServerError,
+            exceptions.DeadlineExceeded,
+        ),
+        initial=1.0,
+        maximum=30.0,
+        timeout=120.0,
+    )
+
+
+def list_descendant_projects(
+    container, folders_client=None, projects_client=None, max_workers=MAX_WORKERS
+) -> Iterator[str]:
+    """
+    Walk the tree under the container breadth-first, with up to max_workers list calls
+    at a time, and yield project IDs (without "projects/" prefix) as they are found.
+    Folders wait in a queue until a worker is free, and no more are listed
+    while the caller is not consuming the project IDs.
+    :param container: org or folder, like "organizations/123" or "folders/456"
+    :param folders_client, projects_client: resource-manager clients, or
+    fakes with the same list_folders and list_projects methods. Default: real clients.
+    :raise the error of a listing that fails even after retries
+    """
     assert container.startswith("organizations/") or container.startswith(
         "folders/"
     ), container
-    folders = list(
-        __list_folders(container)
-    )  # can't have generator because folders vbl used twice
-    projects = __list_projects(container)
-    with ThreadPoolExecutor() as executor:
-        # Using  multithreading speeded a small sample from 15 sec to 6 sec
-        descendants = chain(*executor.map(_list_descendants, folders))
-    return filter(None, chain(folders, projects, descendants))
-
-
-def __list_folders(container):
-    req = resourcemanager_v3.ListFoldersRequest(parent=container)
-    page_result = folders_client.list_folders(request=req)
-    return (resp.name for resp in page_result)
-
-
-def __list_projects(container):
-    request_proj = resourcemanager_v3.ListProjectsRequest(parent=container)
-    page_result = proj_client.list_projects(request=request_proj)
-    return (resp.project_id for resp in page_result)
+    if folders_client is None or projects_client is None:
+        folders_client, projects_client = __default_clients()
+
+    # Folders and projects of a container are listed separately, as (list function, container)
+    to_list = deque([(__list_folders, container), (__list_projects, container)])
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}  # Future to its list function
+        try:
+            while to_list or in_flight:
+                while to_list and len(in_flight) < max_workers:
+                    list_func, parent = to_list.popleft()
+                    future = executor.submit(
+                        list_func, parent, folders_client, projects_client
+                    )
+                    in_flight[future] = list_func
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    list_func = in_flight.pop(future)
+                    names = future.result()
+                    if list_func is __list_folders:
+                        for folder in names:
+                            to_list.append((__list_folders, folder))
+                            to_list.append((__list_projects, folder))
+                    else:
+                        yield from names
+        finally:
+            # Also when the caller stops consuming, or on error
+            for future in in_flight:
+                future.cancel()
+
+
+# noinspection PyUnusedLocal
+def __list_folders(container, folders_client, projects_client) -> List[str]:
+    """:return names of the folders directly under the container"""
+    return [
+        f.name for f in folders_client.list_folders(parent=container, retry=__retry())
+    ]
+
+
+# noinspection PyUnusedLocal
+def __list_projects(container, folders_client, projects_client) -> List[str]:
+    """:return IDs of the projects directly under the container"""
+    return [
+        p.project_id
+        for p in projects_client.list_projects(parent=container, retry=__retry())
+    ]
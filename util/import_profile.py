@@ -0,0 +1,138 @@
+"""
+Profiles the imports of cold start: for each module, the time that importing it took
+and the growth of the resident memory meanwhile, both with and without the modules
+that it imported in turn.
+
+Enable it by setting the environment variable IRIS_PROFILE_IMPORTS (e.g. in env_variables
+of app.yaml) and call install() before any other import, as main.py does.
+log_profile() then logs the most expensive modules, once cold start is done.
+
+This module imports only the standard library, so that it does not profile itself.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from typing import List, Optional
+
+ENV_VAR = "IRIS_PROFILE_IMPORTS"
+
+# How many modules log_profile() logs, most expensive first
+TOP_MODULES = 30
+
+
+class _Record:
+    __slots__ = ("name", "ms", "self_ms", "rss_kb", "self_rss_kb")
+
+    def __init__(self, name):
+        self.name = name
+        self.ms = 0.0
+        self.self_ms = 0.0
+        self.rss_kb = 0
+        self.self_rss_kb = 0
+
+
+__records: List[_Record] = []
+__lock = threading.Lock()
+# Modules being imported, per thread; the innermost last
+__stacks = threading.local()
+__installed = False
+
+
+def enabled() -> bool:
+    return os.environ.get(ENV_VAR, "").lower() not in ("", "0", "false")
+
+
+def rss_kb() -> int:
+    """:return the resident set size of this process in KB, or 0 where unknown (not Linux)"""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") // 1024
+    except Exception:
+        return 0
+
+
+class _ProfilingFinder:
+    """
+    A meta path finder that lets the other finders find the module, then wraps
+    exec_module on the loader they return, which runs the module code.
+    The wrapper is set on the loader instance, rather than wrapping the loader, so
+    that code that inspects loaders (like importlib.resources) sees the usual types.
+    """
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                _wrap_exec_module(spec.loader, fullname)
+                return spec
+        return None
+
+
+def _wrap_exec_module(loader, fullname):
+    # Built-in and frozen modules are loaded by a class shared by all such modules; they are cheap
+    if loader is None or isinstance(loader, type) or not hasattr(loader, "exec_module"):
+        return
+    exec_module = loader.exec_module
+
+    def profiled_exec_module(module):
+        stack = getattr(__stacks, "stack", None)
+        if stack is None:
+            stack = __stacks.stack = []
+        record = _Record(fullname)
+        stack.append(record)
+        start, rss_before = time.perf_counter(), rss_kb()
+        try:
+            exec_module(module)
+        finally:
+            stack.pop()
+            record.ms = (time.perf_counter() - start) * 1000
+            record.rss_kb = rss_kb() - rss_before
+            # The time and memory that are not the importer's own
+            record.self_ms += record.ms
+            record.self_rss_kb += record.rss_kb
+            if stack:
+                stack[-1].self_ms -= record.ms
+                stack[-1].self_rss_kb -= record.rss_kb
+            with __lock:
+                __records.append(record)
+
+    try:
+        loader.exec_module = profiled_exec_module
+    except AttributeError:  # Loaders with __slots__
+        pass
+
+
+def install():
+    """Start profiling imports, if enabled. Call this before importing anything else."""
+    global __installed
+    if enabled() and not __installed:
+        sys.meta_path.insert(0, _ProfilingFinder())
+        __installed = True
+
+
+def log_profile(top: Optional[int] = TOP_MODULES):
+    """Log the modules that took longest to import, if profiling is enabled."""
+    if not __installed:
+        return
+    with __lock:
+        records = sorted(__records, key=lambda r: r.self_ms, reverse=True)
+    total_ms = sum(r.self_ms for r in records)
+    total_rss_kb = sum(r.self_rss_kb for r in records)
+    lines = [
+        f"{r.name}: {r.self_ms:.1f} ms, {r.self_rss_kb} KB "
+        f"(with its imports {r.ms:.1f} ms, {r.rss_kb} KB)"
+        for r in records[:top]
+    ]
+    logging.info(
+        "Imported %d modules in %d ms, adding %d MB RSS; most expensive:\n%s",
+        len(records),
+        total_ms,
+        total_rss_kb // 1024,
+        "\n".join(lines),
+    )
+
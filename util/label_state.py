@@ -0,0 +1,114 @@
+"""
+Cache of label state across cron runs, so that label_all can skip resources
+which have not changed since they were last found to be correctly labeled.
+"""
+import hashlib
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from util.state_store import state_store
+from util.utils import to_snake_case
+
+# Entries for resources not seen for this long (e.g. deleted resources) are dropped
+MAX_ENTRY_AGE_SECONDS = 7 * 24 * 3600
+
+
+def field_value(o, camel_field: str) -> Any:
+    """Reads a field from either a resource converted to a dict with camelCase keys,
+    or an unconverted Cloud Client object, whose attributes are snake_case."""
+    if isinstance(o, dict):
+        return o.get(camel_field)
+    else:
+        return getattr(o, to_snake_case(camel_field), None)
+
+
+def _canonical(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value
+    if hasattr(value, "items"):  # dicts, and maps in Cloud Client objects
+        return repr(sorted((str(k), str(v)) for k, v in value.items()))
+    if hasattr(value, "__iter__"):  # lists, and repeated fields in Cloud Client objects
+        return repr([str(v) for v in value])
+    return str(value)
+
+
+def resource_version(
+    o, key_field: str, version_fields: Tuple[str, ...]
+) -> Optional[Tuple[str, str]]:
+    """:return (resource key, version string), or None if the resource has no key"""
+    key = field_value(o, key_field)
+    if not key:
+        return None
+    version = "|".join(_canonical(field_value(o, f)) for f in version_fields)
+    return str(key), version
+
+
+class LabelState:
+    """
+    Digests of the resources of one plugin in one project which were found to be correctly labeled.
+
+    A digest covers the resource version (e.g., labelFingerprint plus the fields that labels are
+    computed from) and the labeling context (prefixes, label keys and project labels),
+    so that a change in either means the resource is processed again.
+    Resources which were labeled in this run are not recorded, since their
+    fingerprint has changed; the next run finds them correctly labeled and records them.
+    """
+
+    def __init__(self, plugin_name: str, project_id: str, context: str):
+        self.__store = state_store()
+        assert self.__store is not None
+        self.__doc_key = f"label_state/{plugin_name}/{project_id}"
+        self.__context = context
+        self.__lock = threading.Lock()
+        self.__observed = set()
+        self.__current: Dict[str, list] = {}
+        self.__skipped = 0
+        try:
+            doc = self.__store.get(self.__doc_key) or {}
+        except Exception:
+            logging.exception("Cannot load %s; starting from empty", self.__doc_key)
+            doc = {}
+        oldest = time.time() - MAX_ENTRY_AGE_SECONDS
+        self.__previous: Dict[str, list] = {
+            k: v for k, v in doc.get("digests", {}).items() if v[1] >= oldest
+        }
+
+    def __digest(self, version: str) -> str:
+        return hashlib.sha1((self.__context + "\n" + version).encode()).hexdigest()
+
+    def is_unchanged(self, key: str, version: str) -> bool:
+        digest = self.__digest(version)
+        entry = self.__previous.get(key)
+        with self.__lock:
+            self.__observed.add(key)
+            if entry and entry[0] == digest:
+                self.__current[key] = [digest, time.time()]
+                self.__skipped += 1
+                return True
+        return False
+
+    def mark_correctly_labeled(self, key: str, version: str):
+        with self.__lock:
+            self.__current[key] = [self.__digest(version), time.time()]
+
+    def save(self):
+        with self.__lock:
+            digests = {
+                k: v for k, v in self.__previous.items() if k not in self.__observed
+            }
+            digests.update(self.__current)
+            skipped = self.__skipped
+        try:
+            self.__store.put(self.__doc_key, {"digests": digests})
+            logging.info(
+                "Saved label state %s: %d unchanged resources skipped, %d digests",
+                self.__doc_key,
+                skipped,
+                len(digests),
+            )
+        except Exception:
+            logging.exception("Cannot save %s", self.__doc_key)
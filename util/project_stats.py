@@ -0,0 +1,56 @@
+"""
+Per-project statistics from earlier labeling runs, kept in the state store (if one is configured),
+such as how many resources of each type a project has. schedule() uses these to pack
+small projects into one do_label message.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+from util.state_store import state_store
+
+__READ_WORKERS = 16
+
+
+def __doc_key(plugin_name: str, project_id: str) -> str:
+    # One document per plugin and project, since the do_label requests of all plugins
+    # for a project run at the same time, and would overwrite each other's counts
+    return f"project_stats/{plugin_name}/{project_id}"
+
+
+def __get(plugin_name: str, project_id: str) -> Optional[Dict]:
+    try:
+        return state_store().get(__doc_key(plugin_name, project_id))
+    except Exception:
+        logging.exception("Cannot load stats of %s in %s", plugin_name, project_id)
+        return None
+
+
+def resource_counts(
+    project_ids: Iterable[str], plugin_names: Iterable[str]
+) -> Dict[str, Dict[str, int]]:
+    """
+    :return for each project, the number of resources of each plugin that were
+    processed in the last complete run. Projects and plugins without stats are omitted.
+    """
+    if state_store() is None:
+        return {}
+    keys = [(plugin, project) for project in project_ids for plugin in plugin_names]
+    with ThreadPoolExecutor(max_workers=__READ_WORKERS) as executor:
+        docs = executor.map(lambda key: __get(*key), keys)
+    ret = {}
+    for (plugin_name, project_id), doc in zip(keys, docs):
+        if doc:
+            ret.setdefault(project_id, {})[plugin_name] = doc["count"]
+    return ret
+
+
+def record_resource_count(project_id: str, plugin_name: str, count: int):
+    if state_store() is None:
+        return
+    doc = {"count": count, "updated": time.time()}
+    try:
+        state_store().put(__doc_key(plugin_name, project_id), doc)
+    except Exception:
+        logging.exception("Cannot save stats of %s in %s", plugin_name, project_id)
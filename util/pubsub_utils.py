@@ -1,5 +1,8 @@
 import logging
+import time
+from concurrent.futures import wait
 from functools import lru_cache
+from typing import Iterable, List, Tuple
 
 from util import utils
 from util.gcp import gcp_utils
@@ -19,6 +22,29 @@ def __get_publisher():
     return pubsub_v1.PublisherClient()
 
 
+@lru_cache(maxsize=1)
+def __get_bulk_publisher():
+    """A publisher for many messages at once, which batches them, and
+    blocks further publishing while too many are outstanding, to bound memory."""
+    from google.cloud import pubsub_v1
+
+    add_loaded_lib("pubsub_v1")
+    batch_settings = pubsub_v1.types.BatchSettings(
+        max_messages=1000,
+        max_bytes=1024 * 1024,
+        max_latency=0.05,  # seconds
+    )
+    flow_control = pubsub_v1.types.PublishFlowControl(
+        message_limit=5000,
+        byte_limit=10 * 1024 * 1024,
+        limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK,
+    )
+    return pubsub_v1.PublisherClient(
+        batch_settings=batch_settings,
+        publisher_options=pubsub_v1.types.PublisherOptions(flow_control=flow_control),
+    )
+
+
 def logs_topic() -> str:
     return f"iris_logs_topic"
 
@@ -27,6 +53,10 @@ def schedulelabeling_topic() -> str:
     return f"iris_schedulelabeling_topic"
 
 
+def label_deferred_topic() -> str:
+    return "iris_label_deferred_topic"
+
+
 def publish(msg: str, topic_id: str):
     topic_path = __get_publisher().topic_path(gcp_utils.current_project_id(), topic_id)
 
@@ -44,3 +74,51 @@ def publish(msg: str, topic_id: str):
     future.add_done_callback(on_publish)
 
     logging.info("Finished publish attempt %s: %s", topic_id, utils.shorten(msg, 200))
+
+
+class PublishResult:
+    def __init__(self, sent: int, failures: List[Tuple[str, str]]):
+        self.sent = sent
+        # (message, error) for each message that was not sent
+        self.failures = failures
+
+    def __str__(self):
+        return f"{self.sent} sent, {len(self.failures)} failed"
+
+
+def publish_many(
+    msgs: Iterable[str], topic_id: str, timeout: float = 120
+) -> PublishResult:
+    """
+    Publish messages in batches, and wait until all are sent or have failed.
+    :param timeout: seconds to wait, from the start, for all messages to be sent.
+    Messages not sent by then are reported as failures.
+    """
+    start = time.time()
+    publisher = __get_bulk_publisher()
+    topic_path = publisher.topic_path(gcp_utils.current_project_id(), topic_id)
+
+    futures = {}
+    failures = []
+    for msg in msgs:
+        try:
+            futures[publisher.publish(topic_path, msg.encode("utf-8"))] = msg
+        except Exception as e:
+            failures.append((msg, repr(e)))
+
+    remaining = max(0.0, timeout - (time.time() - start))
+    done, not_done = wait(futures, timeout=remaining)
+    failed_futures = 0
+    for future in done:
+        exc = future.exception()
+        if exc is not None:
+            failed_futures += 1
+            failures.append((futures[future], repr(exc)))
+    for future in not_done:
+        failures.append((futures[future], f"Not sent within {timeout} s"))
+
+    result = PublishResult(len(done) - failed_futures, failures)
+    logging.info("Published to %s: %s", topic_id, result)
+    for msg, error in failures[:10]:
+        logging.error("Failed publishing %s: %s", utils.shorten(msg, 200), error)
+    return result
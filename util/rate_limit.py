@@ -0,0 +1,44 @@
+import threading
+import time
+from typing import Dict, Tuple
+
+
+class KeyedRateLimiter:
+    """
+    A token bucket per key, e.g. per table, to match quotas that apply per resource
+    rather than per process. Thread-safe.
+    """
+
+    # Beyond this many keys, full buckets are dropped; they are equivalent to new ones
+    __MAX_KEYS = 10000
+
+    def __init__(self, calls: int, period: float):
+        """Allow bursts of up to `calls`, and on average `calls` per `period` seconds, per key"""
+        self.__capacity = float(calls)
+        self.__rate = calls / period
+        self.__buckets: Dict[str, Tuple[float, float]] = {}  # key -> (tokens, time)
+        self.__lock = threading.Lock()
+
+    def __refilled(self, key, now) -> float:
+        tokens, last = self.__buckets.get(key, (self.__capacity, now))
+        return min(self.__capacity, tokens + (now - last) * self.__rate)
+
+    def __prune(self, now):
+        full = [k for k in self.__buckets if self.__refilled(k, now) >= self.__capacity]
+        for k in full:
+            del self.__buckets[k]
+
+    def acquire(self, key: str):
+        """Block until a call is allowed for this key"""
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                tokens = self.__refilled(key, now)
+                if tokens >= 1:
+                    self.__buckets[key] = (tokens - 1, now)
+                    if len(self.__buckets) > self.__MAX_KEYS:
+                        self.__prune(now)
+                    return
+                self.__buckets[key] = (tokens, now)
+                wait = (1 - tokens) / self.__rate
+            time.sleep(wait)
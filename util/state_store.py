@@ -0,0 +1,110 @@
+"""
+Persistence of small JSON documents across runs and across App Engine instances.
+Which store is used (if any) is configured with the state_store key in the config file.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+from abc import ABCMeta, abstractmethod
+from functools import lru_cache
+from typing import Dict, Optional
+
+from util.config_utils import state_store_location
+from util.gcp.gcp_utils import add_loaded_lib
+from util.utils import mkdirs
+
+GCS_SCHEME = "gs://"
+
+
+class StateStore(metaclass=ABCMeta):
+    @abstractmethod
+    def get(self, key: str) -> Optional[Dict]:
+        """:return the document stored under key, or None if there is none"""
+        pass
+
+    @abstractmethod
+    def put(self, key: str, doc: Dict):
+        pass
+
+
+class LocalFileStateStore(StateStore):
+    """For local development: One JSON file per key"""
+
+    def __init__(self, dir_: str):
+        self.__dir = dir_
+        self.__lock = threading.Lock()
+
+    def __path(self, key):
+        return os.path.join(self.__dir, key + ".json")
+
+    def get(self, key: str) -> Optional[Dict]:
+        try:
+            with open(self.__path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, doc: Dict):
+        path = self.__path(key)
+        with self.__lock:
+            mkdirs(os.path.dirname(path))
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(doc, f)
+            os.replace(tmp_path, path)  # So that readers never see a partial file
+
+
+class GcsStateStore(StateStore):
+    """One JSON object per key, in a Cloud Storage bucket, shared by all App Engine instances"""
+
+    def __init__(self, bucket_name: str, prefix: str = ""):
+        self.__bucket_name = bucket_name
+        self.__prefix = prefix.strip("/")
+
+    @lru_cache(maxsize=1)
+    def __bucket(self):
+        # Local import to avoid burdening AppEngine memory.
+        # Loading all Cloud Client libraries would be 100MB  means that
+        # the default AppEngine Instance crashes on out-of-memory even before actually serving a request.
+        from google.cloud import storage
+
+        add_loaded_lib("storage")
+        return storage.Client().bucket(self.__bucket_name)
+
+    def __blob(self, key):
+        name = f"{self.__prefix}/{key}.json" if self.__prefix else f"{key}.json"
+        return self.__bucket().blob(name)
+
+    def get(self, key: str) -> Optional[Dict]:
+        from google.api_core.exceptions import NotFound
+
+        try:
+            return json.loads(self.__blob(key).download_as_bytes())
+        except NotFound:
+            return None
+
+    def put(self, key: str, doc: Dict):
+        self.__blob(key).upload_from_string(
+            json.dumps(doc), content_type="application/json"
+        )
+
+
+@lru_cache(maxsize=1)
+def state_store() -> Optional[StateStore]:
+    """:return the configured store, or None if state is not persisted"""
+    location = state_store_location()
+    if not location:
+        return None
+    elif location == "local":
+        dir_ = os.path.join(tempfile.gettempdir(), "iris_state")
+        logging.info("State is stored locally in %s", dir_)
+        return LocalFileStateStore(dir_)
+    elif location.startswith(GCS_SCHEME):
+        bucket_name, _, prefix = location[len(GCS_SCHEME) :].partition("/")
+        return GcsStateStore(bucket_name, prefix)
+    else:
+        raise ValueError(
+            f"state_store must be empty, 'local', or gs://<bucket>; was {location}"
+        )
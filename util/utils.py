@@ -2,15 +2,18 @@ import logging
 import os
 import pathlib
 import random
+import re
 import string
 import subprocess
 import sys
 import textwrap
+import threading
 import time
 import typing
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
 from contextlib import contextmanager
-from datetime import datetime, timedelta
-from functools import lru_cache, wraps
+from functools import wraps
 
 import flask
 
@@ -183,20 +186,148 @@ def timing(tag: str) -> None:
     __log_end_timer(tag, start, "time")
 
 
-def timed_lru_cache(seconds: int, maxsize: int = 128):
+class TtlCache:
+    """
+    A cache in which each entry expires ttl_seconds after it was loaded, rather than
+    all entries at once. Thread-safe.
+    - Concurrent misses for one key wait for a single load (single-flight).
+    - For stale_seconds after an entry expires, get returns the stale value at once, and
+      reloads it on a background thread (stale-while-revalidate).
+    - Beyond maxsize entries, the least recently used are evicted.
+    An exception from a load is raised to all callers waiting for it, and is not cached.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ttl_seconds: float,
+        maxsize: int = 128,
+        stale_seconds: float = 0,
+    ):
+        self.__ttl = ttl_seconds
+        self.__stale = stale_seconds
+        self.__maxsize = maxsize
+        # For each key, its value and when it was loaded; least recently used first
+        self.__entries: OrderedDict = OrderedDict()
+        # For each key being loaded, the Future of its value
+        self.__loading: typing.Dict[typing.Hashable, Future] = {}
+        self.__lock = threading.Lock()
+        self.__stats = Counter()
+        with _ttl_caches_lock:
+            _ttl_caches[name] = self
+
+    def get(self, key: typing.Hashable, load: typing.Callable[[], typing.Any]):
+        """:return the value for the key, calling load() if it is missing or expired"""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                value, loaded_at = entry
+                age = time.time() - loaded_at
+                if age < self.__ttl + self.__stale:
+                    self.__entries.move_to_end(key)
+                    if age < self.__ttl:
+                        self.__stats["hits"] += 1
+                    else:
+                        self.__stats["stale_hits"] += 1
+                        if key not in self.__loading:
+                            self.__start_background_load(key, load)
+                    return value
+            self.__stats["misses"] += 1
+            loading = self.__loading.get(key)
+            is_loader = loading is None
+            if is_loader:
+                loading = self.__loading[key] = Future()
+        if is_loader:
+            self.__load(key, load, loading)
+        return loading.result()
+
+    def __start_background_load(self, key, load):
+        """Called with the lock held"""
+        loading = self.__loading[key] = Future()
+
+        def revalidate():
+            self.__load(key, load, loading)
+            if loading.exception() is not None:
+                logging.error(
+                    "Cannot reload cache entry %s", key, exc_info=loading.exception()
+                )
+
+        threading.Thread(target=revalidate, daemon=True).start()
+
+    def __load(self, key, load, loading: Future):
+        try:
+            value = load()
+        except BaseException as e:
+            with self.__lock:
+                self.__stats["load_errors"] += 1
+                self.__loading.pop(key, None)
+            loading.set_exception(e)
+            return
+        with self.__lock:
+            self.__stats["loads"] += 1
+            self.__put(key, value, time.time())
+            self.__loading.pop(key, None)
+        loading.set_result(value)
+
+    def __put(self, key, value, loaded_at):
+        """Called with the lock held"""
+        self.__entries[key] = (value, loaded_at)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.__maxsize:
+            self.__entries.popitem(last=False)
+            self.__stats["evictions"] += 1
+
+    def put(
+        self, key: typing.Hashable, value, loaded_at: typing.Optional[float] = None
+    ):
+        """Add a value that was loaded elsewhere"""
+        with self.__lock:
+            self.__put(key, value, time.time() if loaded_at is None else loaded_at)
+
+    def peek(self, key: typing.Hashable, default=None):
+        """:return the value for the key if it is cached and not expired, without loading it"""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or time.time() - entry[1] >= self.__ttl:
+                return default
+            return entry[0]
+
+    def stats(self) -> typing.Dict[str, int]:
+        """:return counts of hits, stale hits, misses, loads, load errors and evictions,
+        and the current size"""
+        with self.__lock:
+            return {**self.__stats, "size": len(self.__entries)}
+
+
+# All TtlCaches by name, for ttl_cache_stats
+_ttl_caches: typing.Dict[str, TtlCache] = {}
+_ttl_caches_lock = threading.Lock()
+
+
+def ttl_cache_stats() -> typing.Dict[str, typing.Dict[str, int]]:
+    with _ttl_caches_lock:
+        caches = dict(_ttl_caches)
+    return {name: cache.stats() for name, cache in sorted(caches.items())}
+
+
+def ttl_cache(seconds: float, maxsize: int = 128, stale_seconds: float = 0):
+    """
+    Decorator that caches the results of a function in a TtlCache, keyed by
+    its (hashable) arguments. The cache is the attribute `cache` of the decorated function.
+    Use it on plain functions: on a method, the key would include self.
+    """
+
     def wrapper_cache(func):
-        func = lru_cache(maxsize=maxsize)(func)
-        func.lifetime = timedelta(seconds=seconds)
-        func.expiration = datetime.utcnow() + func.lifetime
+        cache = TtlCache(
+            f"{func.__module__}.{func.__qualname__}", seconds, maxsize, stale_seconds
+        )
 
         @wraps(func)
         def wrapped_func(*args, **kwargs):
-            if datetime.utcnow() >= func.expiration:
-                func.cache_clear()
-                func.expiration = datetime.utcnow() + func.lifetime
-
-            return func(*args, **kwargs)
+            key = (args, tuple(sorted(kwargs.items())))
+            return cache.get(key, lambda: func(*args, **kwargs))
 
+        wrapped_func.cache = cache
         return wrapped_func
 
     return wrapper_cache
@@ -230,6 +361,10 @@ def to_camel_case(snake_str):
     return components[0] + "".join(x.title() for x in components[1:])
 
 
+def to_snake_case(camel_str):
+    return re.sub(r"([A-Z])", r"_\1", camel_str).lower()
+
+
 def dict_to_camelcase(d):
     ret_camel = {to_camel_case(k): v for k, v in d.items()}
     return ret_camel
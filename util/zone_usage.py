@@ -0,0 +1,45 @@
+"""
+The zones that held resources of each zonal GCE plugin in each project, as found by the last
+full sweep (an aggregated listing, or a listing of all zones), kept in the state store
+(if one is configured). Most projects use only a few zones, so per-zone listing can
+skip the other zones until the record is older than zone_usage_ttl_seconds.
+"""
+import logging
+import time
+from typing import Iterable, List, Optional
+
+from util.config_utils import zone_usage_ttl_seconds
+from util.state_store import state_store
+
+
+def __doc_key(plugin_name: str, project_id: str) -> str:
+    return f"zone_usage/{plugin_name}/{project_id}"
+
+
+def active_zones(plugin_name: str, project_id: str) -> Optional[List[str]]:
+    """
+    :return the zones that held resources at the last full sweep, or None if
+    there is no record recent enough, in which case all zones should be listed
+    """
+    ttl = zone_usage_ttl_seconds()
+    if state_store() is None or ttl == 0:
+        return None
+    try:
+        doc = state_store().get(__doc_key(plugin_name, project_id))
+    except Exception:
+        logging.exception("Cannot load zone usage of %s", project_id)
+        return None
+    if doc is None or time.time() >= doc["swept"] + ttl:
+        return None
+    return doc["zones"]
+
+
+def record_full_sweep(plugin_name: str, project_id: str, zones: Iterable[str]):
+    """:param zones: the zones that held resources, when all zones were listed"""
+    if state_store() is None or zone_usage_ttl_seconds() == 0:
+        return
+    doc = {"zones": sorted(zones), "swept": time.time()}
+    try:
+        state_store().put(__doc_key(plugin_name, project_id), doc)
+    except Exception:
+        logging.exception("Cannot save zone usage of %s", project_id)